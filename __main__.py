@@ -0,0 +1,11 @@
+import os
+import sys
+
+# Lets the app folder be run as `python -m batchsnap_sorter ...` from its
+# parent directory; the modules themselves use flat imports
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sort_cli import main
+
+if __name__ == '__main__':
+    sys.exit(main())
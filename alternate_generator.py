@@ -3,10 +3,11 @@ from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 import os
 import sys
-import pickle
+from embedding_store import save_embeddings
 import numpy as np
 import face_recognition as FR
 from utilities import ImageUtilities as IU
+from utilities import valid_name
 
 
 class AlternateGenerator(QWidget):
@@ -20,6 +21,8 @@ class AlternateGenerator(QWidget):
         self.info = QLabel()
         self.images = QLabel()
         self.status = QLabel()
+        self.name = QLineEdit()
+        self.name.setPlaceholderText('Name of the person (optional)')
         self.button = QPushButton('Select images to use')
         self.generate = QPushButton('Generate training data')
         self.button.clicked.connect(self.select_images)
@@ -34,6 +37,7 @@ class AlternateGenerator(QWidget):
         self.box.addWidget(self.info)
         self.box.addWidget(self.button)
         self.box.addWidget(self.images)
+        self.box.addWidget(self.name)
         self.box.addWidget(self.generate)
         self.box.addWidget(self.status)
 
@@ -55,6 +59,10 @@ class AlternateGenerator(QWidget):
             error = QErrorMessage()
             error.showMessage('Select atleast 10 images')
             error.exec_()
+        elif self.name.text().strip() and not valid_name(self.name.text().strip()):
+            error = QErrorMessage()
+            error.showMessage('A name cannot contain slashes or start with a dot')
+            error.exec_()
         else:
             utils = IU()
             self.status.setText('Generating training data...')
@@ -71,8 +79,14 @@ class AlternateGenerator(QWidget):
                     pass
                 else:
                     encodings.append(encoding[0])
-            with open('models/training_data.clf', 'wb') as file:
-                pickle.dump(encodings, file)
+            save_path = 'models/training_data.emb'
+            name = self.name.text().strip()
+            if name:
+                save_path = utils.people_path(name)
+                if not os.path.isdir('models/people'):
+                    os.makedirs('models/people')
+            save_embeddings(save_path, encodings, encoder='128D',
+                            detector='hog')
             self.status.setText('Done!')
 
 def main():
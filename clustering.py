@@ -0,0 +1,182 @@
+import os
+import re
+import numpy as np
+from gallery_index import make_index
+from output_modes import OutputWriter
+from utilities import ImageUtilities as IU
+from utilities import PEOPLE_DIR
+from embedding_store import save_embeddings
+
+
+def neighbour_graph(matrix, threshold, neighbours=32, index='auto'):
+    # Edges between each face and those of its nearest neighbours that are
+    # within threshold. The index searches in blocks (or approximately, for
+    # big folders), so the full distance matrix never exists
+    index = make_index(index, size=len(matrix)).fit(matrix)
+    (distances, rows) = index.search(matrix, neighbours + 1)
+    sources = np.repeat(np.arange(len(matrix)), rows.shape[1])
+    targets = rows.ravel()
+    distances = distances.ravel()
+    keep = (targets >= 0) & (targets != sources) & (distances <= threshold)
+    (sources, targets, distances) = (sources[keep], targets[keep],
+                                     distances[keep])
+    # kNN is not symmetric, so an edge may be found from either end (or
+    # both); keep each pair once
+    (low, high) = (np.minimum(sources, targets), np.maximum(sources, targets))
+    first = np.unique(low*len(matrix) + high, return_index=True)[1]
+    (low, high, distances) = (low[first], high[first], distances[first])
+    # Closer faces pull harder
+    weights = np.maximum(threshold - distances, 1e-3)
+    return low, high, weights
+
+
+def chinese_whispers(count, sources, targets, weights, iterations=20,
+                     seed=19):
+    # Each face takes the label with the most edge weight among its
+    # neighbours. Updating a random half of the faces per round keeps the
+    # vectorised (synchronous) version from oscillating
+    state = np.random.RandomState(seed)
+    labels = np.arange(count)
+    nodes = np.concatenate([sources, targets])
+    others = np.concatenate([targets, sources])
+    weights = np.concatenate([weights, weights])
+    if len(nodes) == 0:
+        return labels
+    for i in range(iterations):
+        keys = labels[others]
+        order = np.lexsort((keys, nodes))
+        (n, k, w) = (nodes[order], keys[order], weights[order])
+        starts = np.flatnonzero(np.concatenate([[True],
+                                                (n[1:] != n[:-1]) |
+                                                (k[1:] != k[:-1])]))
+        sums = np.add.reduceat(w, starts)
+        (n, k) = (n[starts], k[starts])
+        order = np.lexsort((-sums, n))
+        (n, k) = (n[order], k[order])
+        first = np.concatenate([[True], n[1:] != n[:-1]])
+        best = labels.copy()
+        best[n[first]] = k[first]
+        if not (best != labels).any():
+            break
+        update = state.rand(count) < 0.5
+        labels[update] = best[update]
+    return labels
+
+
+class FaceClusterer(object):
+
+    def __init__(self, threshold=None, neighbours=32, min_size=2,
+                 index='auto'):
+        self.utils = IU()
+        self.folder = None
+        self.face_model = 'hog'
+        self.encoding_model = '128D'
+        self.jitters = 3
+        self.upsample = 1
+        self.threshold = threshold
+        self.neighbours = neighbours
+        self.min_size = min_size
+        self.index = index
+
+    def set_params(self, model, encoding, jitters, upsample):
+        self.face_model = model
+        self.encoding_model = encoding
+        self.jitters = jitters
+        self.upsample = upsample
+
+    def set_folder(self, folder):
+        self.folder = folder
+
+    def set_cache(self, cache):
+        self.utils.cache = cache
+
+    def set_detection(self, pixels, second_pass=True):
+        self.utils.detection_pixels = pixels
+        self.utils.second_pass = second_pass
+
+    def default_threshold(self):
+        if self.encoding_model == '512D':
+            return 1.0
+        return 0.5
+
+    def cluster(self, image_paths, batch_size=32):
+        # Returns (clusters, unclustered): clusters is a list, biggest first,
+        # of lists of (image path, face index, encoding); faces in clusters
+        # smaller than min_size are unclustered
+        threshold = self.threshold or self.default_threshold()
+        encodings, owners = self.utils.encode_images(
+            image_paths,
+            face_model=self.face_model,
+            scaleup=self.upsample,
+            encoding_model=self.encoding_model,
+            jitters=self.jitters,
+            batch_size=batch_size)
+        if len(owners) == 0:
+            return list(), list()
+        (sources, targets, weights) = neighbour_graph(encodings, threshold,
+                                                      self.neighbours,
+                                                      self.index)
+        labels = chinese_whispers(len(owners), sources, targets, weights)
+        (ids, index, counts) = np.unique(labels, return_inverse=True,
+                                         return_counts=True)
+        clusters = [list() for i in range(len(ids))]
+        for (row, (owner, i)) in enumerate(owners):
+            clusters[index[row]].append((owner, i, encodings[row]))
+        clusters.sort(key=len, reverse=True)
+        unclustered = [face for faces in clusters if len(faces) < self.min_size
+                       for face in faces]
+        clusters = [faces for faces in clusters if len(faces) >= self.min_size]
+        return clusters, unclustered
+
+    def cluster_name(self, i):
+        return 'cluster_{:04d}'.format(i + 1)
+
+    def write(self, clusters, sort_path, mode='copy',
+              manifest_name='clusters.tsv'):
+        # One folder per cluster (unless mode is manifest), plus a manifest
+        # of every clustered face in sort_path
+        if not os.path.exists(sort_path):
+            os.makedirs(sort_path)
+        folders = dict()
+        with open(os.path.join(sort_path, manifest_name), 'w') as file:
+            for (i, faces) in enumerate(clusters):
+                name = self.cluster_name(i)
+                for (image_path, face, encoding) in faces:
+                    file.write('{}\t{}\t{}\n'.format(
+                        name, os.path.abspath(image_path), face))
+                    names = folders.setdefault(image_path, list())
+                    if name not in names:
+                        names.append(name)
+        if mode == 'manifest':
+            return
+        output = OutputWriter(sort_path, mode=mode)
+        output.open()
+        try:
+            # A photo of several people goes to each of their folders
+            for (image_path, names) in folders.items():
+                output.route(image_path, names)
+        finally:
+            output.close()
+
+    def export_people(self, clusters):
+        # Saves each cluster as a training set for the gallery sorter; the
+        # files can be renamed to the person's name afterwards
+        if not os.path.isdir(PEOPLE_DIR):
+            os.makedirs(PEOPLE_DIR)
+        paths = list()
+        for (i, faces) in enumerate(clusters):
+            path = save_embeddings(self.utils.people_path(self.cluster_name(i)),
+                                   [encoding for (image_path, face, encoding)
+                                    in faces],
+                                   encoder=self.encoding_model,
+                                   detector=self.face_model)
+            paths.append(path)
+        return paths
+
+    def get_image_list(self):
+        images_list = list()
+        for path in os.listdir(self.folder):
+            if re.match('.*\.(jpg|png)', path.lower()):
+                images_list.append(os.path.join(self.folder, path))
+        images_list.sort()
+        return images_list
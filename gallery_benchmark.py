@@ -0,0 +1,72 @@
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from gallery_index import INDEXES
+
+
+def synthetic_people(size, dim, people, seed=19):
+    # Clustered unit vectors, roughly like face encodings of many people,
+    # and the person of each
+    state = np.random.RandomState(seed)
+    centres = state.randn(people, dim).astype(np.float32)
+    labels = state.randint(people, size=size)
+    vectors = centres[labels] + 0.3*state.randn(size, dim).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1)[:, None]
+    return vectors, labels
+
+
+def synthetic_gallery(size, dim, people, seed=19):
+    return synthetic_people(size, dim, people, seed)[0]
+
+
+def measure(index, queries, truth, k):
+    start = time.time()
+    for query in queries:
+        index.search(query[None, :], k)
+    single = (time.time() - start)/len(queries)
+    start = time.time()
+    (distances, rows) = index.search(queries, k)
+    batched = (time.time() - start)/len(queries)
+    recall = np.mean([len(set(found) & set(expected))/float(k)
+                      for (found, expected) in zip(rows, truth)])
+    return {'index': index.kind, 'vectors': len(index),
+            'query_ms': round(single*1000, 4),
+            'batched_query_ms': round(batched*1000, 4),
+            'recall_at_{}'.format(k): round(float(recall), 4)}
+
+
+def build(kind, vectors):
+    start = time.time()
+    index = INDEXES[kind]().fit(vectors)
+    return index, round(time.time() - start, 3)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Recall and latency of the gallery indexes')
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--people', type=int, default=5000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--k', type=int, default=1)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 8, 16, 32])
+    args = parser.parse_args(argv)
+    vectors = synthetic_gallery(args.size + args.queries, args.dim, args.people)
+    (vectors, queries) = (vectors[:args.size], vectors[args.size:])
+    (brute, built) = build('brute', vectors)
+    truth = brute.search(queries, args.k)[1]
+    result = measure(brute, queries, truth, args.k)
+    result['build_seconds'] = built
+    sys.stdout.write(json.dumps(result) + '\n')
+    # nprobe only matters at search time, so the lists are built once
+    (ivf, built) = build('ivf', vectors)
+    for nprobe in args.nprobe:
+        ivf.nprobe = nprobe
+        result = measure(ivf, queries, truth, args.k)
+        result.update(build_seconds=built, nprobe=nprobe)
+        sys.stdout.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
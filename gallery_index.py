@@ -0,0 +1,183 @@
+import numpy as np
+from quantization import check_precision, quantize, nbytes, squared_norms
+from quantization import products, squared_distances
+
+
+class BruteForceIndex(object):
+    # Exact search: one matrix product per block of queries. With a
+    # float16 or int8 precision the vectors are stored quantised, and
+    # distances are computed from the codes
+
+    kind = 'brute'
+    # Indexes pickled by older versions were all float32
+    precision = 'float32'
+    scale = None
+    order = None
+
+    def __init__(self, block=1024, precision='float32'):
+        check_precision(precision)
+        self.block = block
+        self.precision = precision
+        self.vectors = None
+        self.scale = None
+        self.norms = None
+
+    def __len__(self):
+        return 0 if self.vectors is None else len(self.vectors)
+
+    def fit(self, vectors):
+        (self.vectors, self.scale) = quantize(vectors, self.precision)
+        self.norms = squared_norms(self.vectors, self.scale)
+        return self
+
+    def nbytes(self):
+        return nbytes(self.vectors, self.scale) + self.norms.nbytes
+
+    def search(self, queries, k=1):
+        # Returns (distances, rows), both (queries, k), nearest first
+        queries = np.atleast_2d(np.asarray(queries, dtype=self.norms.dtype))
+        k = min(k, len(self))
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        rows = np.empty((len(queries), k), dtype=np.int64)
+        for start in range(0, len(queries), self.block):
+            chunk = queries[start:start+self.block]
+            (d, r) = self.nearest(chunk, self.vectors, self.norms, k,
+                                  self.scale)
+            distances[start:start+len(chunk)] = d
+            rows[start:start+len(chunk)] = r
+        return distances, rows
+
+    def within(self, queries, radius):
+        # Every (query, row) pair closer than radius, checked exactly
+        # against all vectors
+        queries = np.atleast_2d(np.asarray(queries, dtype=self.norms.dtype))
+        faces = [np.empty(0, dtype=np.int64)]
+        rows = [np.empty(0, dtype=np.int64)]
+        for start in range(0, len(queries), self.block):
+            chunk = queries[start:start+self.block]
+            squared = squared_distances(chunk, self.vectors, self.scale,
+                                        self.norms)
+            (f, r) = np.nonzero(squared <= radius*radius)
+            faces.append(f + start)
+            rows.append(r)
+        (faces, rows) = (np.concatenate(faces), np.concatenate(rows))
+        if self.order is not None:
+            rows = self.order[rows]
+        return faces, rows
+
+    def nearest(self, queries, vectors, norms, k, scale=None):
+        squared = squared_distances(queries, vectors, scale, norms)
+        if k < squared.shape[1]:
+            rows = np.argpartition(squared, k - 1, axis=1)[:, :k]
+        else:
+            rows = np.tile(np.arange(squared.shape[1]), (len(queries), 1))
+        picked = np.take_along_axis(squared, rows, axis=1)
+        order = np.argsort(picked, axis=1)
+        rows = np.take_along_axis(rows, order, axis=1)
+        picked = np.take_along_axis(picked, order, axis=1)
+        return np.sqrt(np.maximum(picked, 0)), rows
+
+
+class IVFIndex(BruteForceIndex):
+    # Approximate search: vectors are split into lists around k-means
+    # centroids, and a query only looks at the nprobe nearest lists
+
+    kind = 'ivf'
+
+    def __init__(self, lists=None, nprobe=8, iterations=10, sample=50000,
+                 block=1024, precision='float32'):
+        super(IVFIndex, self).__init__(block=block, precision=precision)
+        self.lists = lists
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.sample = sample
+        self.centroids = None
+        self.offsets = None
+        self.order = None
+
+    def fit(self, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        lists = self.lists
+        if lists is None:
+            lists = int(round(np.sqrt(len(vectors))))
+        lists = max(1, min(lists, len(vectors)))
+        self.centroids = self.kmeans(vectors, lists)
+        assigned = self.assign(vectors)
+        # Store the vectors grouped by list, so each list is one slice
+        self.order = np.argsort(assigned, kind='stable')
+        counts = np.bincount(assigned, minlength=lists)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        super(IVFIndex, self).fit(vectors[self.order])
+        return self
+
+    def kmeans(self, vectors, lists):
+        state = np.random.RandomState(19)
+        train = vectors
+        if len(train) > self.sample:
+            train = train[state.choice(len(train), self.sample, replace=False)]
+        centroids = train[state.choice(len(train), lists, replace=False)].copy()
+        for i in range(self.iterations):
+            self.centroids = centroids
+            assigned = self.assign(train)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assigned, train)
+            counts = np.bincount(assigned, minlength=lists)
+            filled = counts > 0
+            centroids[filled] = sums[filled]/counts[filled][:, None]
+        return centroids
+
+    def assign(self, vectors):
+        norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        assigned = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), self.block):
+            chunk = vectors[start:start+self.block]
+            assigned[start:start+len(chunk)] = self.nearest(chunk,
+                                                            self.centroids,
+                                                            norms, 1)[1][:, 0]
+        return assigned
+
+    def search(self, queries, k=1):
+        queries = np.atleast_2d(np.asarray(queries, dtype=self.norms.dtype))
+        k = min(k, len(self))
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        nprobe = min(self.nprobe, len(self.centroids))
+        probes = self.nearest(queries, self.centroids, norms, nprobe)[1]
+        for (i, query) in enumerate(queries):
+            # Each list is a contiguous slice, so nothing is copied
+            squared = list()
+            candidates = list()
+            for p in probes[i]:
+                (first, last) = (self.offsets[p], self.offsets[p+1])
+                if first == last:
+                    continue
+                squared.append(self.norms[first:last]
+                               - 2*products(query[None, :],
+                                            self.vectors[first:last],
+                                            self.scale)[0])
+                candidates.append(np.arange(first, last))
+            if len(squared) == 0:
+                continue
+            squared = np.concatenate(squared) + np.dot(query, query)
+            candidates = np.concatenate(candidates)
+            found = min(k, len(candidates))
+            picked = np.argpartition(squared, found - 1)[:found]
+            picked = picked[np.argsort(squared[picked])]
+            distances[i, :found] = np.sqrt(np.maximum(squared[picked], 0))
+            rows[i, :found] = self.order[candidates[picked]]
+        return distances, rows
+
+
+INDEXES = {'brute': BruteForceIndex, 'ivf': IVFIndex}
+
+# Galleries smaller than this are searched exactly
+IVF_THRESHOLD = 20000
+
+
+def make_index(kind='auto', size=0, **params):
+    if kind == 'auto':
+        kind = 'ivf' if size >= IVF_THRESHOLD else 'brute'
+    if kind not in INDEXES:
+        raise Exception("Invalid gallery index: {}".format(kind))
+    return INDEXES[kind](**params)
@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import threading
+
+JOURNAL_NAME = '.sort_journal.jsonl'
+
+
+class RunJournal(object):
+    # Append-only record of finished images, so an interrupted sort can
+    # pick up where it stopped. The first line holds the run's parameters;
+    # a journal written with other parameters is started over
+
+    def __init__(self, path, params, sync_every=64, sync_interval=1.0):
+        self.path = path
+        self.params = params
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.done = dict()
+        self.file = None
+        self.pending = 0
+        self.synced = time.time()
+        self.lock = threading.Lock()
+
+    def open(self):
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        if self.load():
+            self.file = open(self.path, 'a')
+        else:
+            self.done.clear()
+            self.file = open(self.path, 'w')
+            self.file.write(json.dumps({'params': self.params}) + '\n')
+            self.sync()
+        return self
+
+    def load(self):
+        # Returns False if there is no usable journal for these parameters
+        if not os.path.isfile(self.path):
+            return False
+        with open(self.path, 'rb') as file:
+            data = file.read()
+        # A crash can leave half a line at the end; drop it
+        end = data.rfind(b'\n') + 1
+        lines = data[:end].decode('utf-8').splitlines()
+        if len(lines) == 0:
+            return False
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            return False
+        if header.get('params') != self.params:
+            return False
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            self.done[record['image']] = record
+        if end < len(data):
+            with open(self.path, 'r+b') as file:
+                file.truncate(end)
+        return True
+
+    def signature(self, image_path):
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def completed(self, image_path):
+        # The recorded outcome, or None if the image still has to be
+        # sorted (never done, or changed since)
+        record = self.done.get(os.path.abspath(image_path))
+        if record is None:
+            return None
+        # Moved images have no file left to compare with
+        current = self.signature(image_path)
+        if current is not None and current != record['file']:
+            return None
+        return record['matched']
+
+    def record(self, image_path, matched, signature=None):
+        # signature is the image's (mtime, size) from before it was written
+        # out, since a move takes the file away
+        if signature is None:
+            signature = self.signature(image_path)
+        record = {'image': os.path.abspath(image_path),
+                  'file': signature,
+                  'matched': matched}
+        with self.lock:
+            self.done[record['image']] = record
+            self.file.write(json.dumps(record) + '\n')
+            self.pending += 1
+            if (self.pending >= self.sync_every or
+                    time.time() - self.synced >= self.sync_interval):
+                self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+        self.synced = time.time()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.sync()
+                self.file.close()
+                self.file = None
+
+    def finish(self):
+        # The run completed, so there is nothing left to resume
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
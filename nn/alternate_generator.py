@@ -3,7 +3,7 @@ from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 import os
 import sys
-import pickle
+from embedding_store import save_embeddings
 import numpy as np
 import face_recognition as FR
 import cv2
@@ -53,9 +53,9 @@ class AlternateGenerator(QWidget):
 
     def generate_training_set(self, model='+'):
         if model == '+':
-            model_path = 'models/training_data_positive.clf'
+            model_path = 'models/training_data_positive.emb'
         else:
-            model_path = 'models/training_data_negative.clf'
+            model_path = 'models/training_data_negative.emb'
         if self.paths is None or len(self.paths) < 10:
             error = QErrorMessage()
             error.setWindowTitle('Error')
@@ -77,8 +77,8 @@ class AlternateGenerator(QWidget):
                         continue
                     else:
                         encodings.append(encoding[0])
-            with open(model_path, 'wb') as file:
-                pickle.dump(encodings, file)
+            save_embeddings(model_path, encodings, encoder='128D',
+                            detector='hog')
             self.status.setText('Done!')
 
 def main():
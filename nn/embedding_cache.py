@@ -0,0 +1,246 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from quantization import check_precision, quantize, dequantize
+
+
+class EmbeddingCache(object):
+
+    def __init__(self, path='models/embedding_cache.db',
+                 max_bytes=512*1024*1024, commit_every=64,
+                 precision='float64'):
+        # precision only applies to new entries; each row records its own
+        check_precision(precision)
+        self.path = path
+        self.precision = precision
+        self.max_bytes = max_bytes
+        self.commit_every = commit_every
+        self.pending = 0
+        self.lock = threading.RLock()
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.db = sqlite3.connect(path, timeout=30,
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS files (
+                           path TEXT PRIMARY KEY, mtime INTEGER,
+                           size INTEGER, digest TEXT)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS detections (
+                           digest TEXT, face_model TEXT, upsample INTEGER,
+                           boxes BLOB, bytes INTEGER, last_used REAL,
+                           PRIMARY KEY (digest, face_model, upsample))''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS encodings (
+                           digest TEXT, face_model TEXT, upsample INTEGER,
+                           encoding_model TEXT, jitters INTEGER,
+                           boxes BLOB, data BLOB, dim INTEGER,
+                           bytes INTEGER, last_used REAL, precision TEXT,
+                           PRIMARY KEY (digest, face_model, upsample,
+                                        encoding_model, jitters))''')
+        columns = [row[1] for row in
+                   self.db.execute('PRAGMA table_info(encodings)')]
+        if 'precision' not in columns:
+            # Caches from older versions hold float64 encodings
+            self.db.execute('ALTER TABLE encodings ADD COLUMN precision TEXT')
+        self.db.commit()
+        self.total = self.size()
+
+    def file_key(self, image_path):
+        # Hash the file contents, but only when its mtime or size changed
+        stat = os.stat(image_path)
+        path = os.path.abspath(image_path)
+        with self.lock:
+            row = self.db.execute('SELECT mtime, size, digest FROM files '
+                                  'WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+            return row[2]
+        digest = hashlib.sha1()
+        with open(image_path, 'rb') as file:
+            for block in iter(lambda: file.read(1024*1024), b''):
+                digest.update(block)
+        digest = digest.hexdigest()
+        with self.lock:
+            try:
+                self.db.execute('INSERT OR REPLACE INTO files VALUES '
+                                '(?, ?, ?, ?)',
+                                (path, stat.st_mtime_ns, stat.st_size, digest))
+                self.changed()
+            except sqlite3.OperationalError:
+                self.failed()
+        return digest
+
+    def get_locations(self, key, face_model, upsample):
+        with self.lock:
+            row = self.db.execute('SELECT boxes FROM detections WHERE '
+                                  'digest = ? AND face_model = ? AND '
+                                  'upsample = ?',
+                                  (key, face_model, upsample)).fetchone()
+            if row is None:
+                return None
+            try:
+                self.db.execute('UPDATE detections SET last_used = ? WHERE '
+                                'digest = ? AND face_model = ? AND '
+                                'upsample = ?',
+                                (time.time(), key, face_model, upsample))
+                self.changed()
+            except sqlite3.OperationalError:
+                self.failed()
+        return self.unpack_boxes(row[0])
+
+    def put_locations(self, key, face_model, upsample, locs):
+        boxes = self.pack_boxes(locs)
+        with self.lock:
+            try:
+                old = self.db.execute('SELECT bytes FROM detections WHERE '
+                                      'digest = ? AND face_model = ? AND '
+                                      'upsample = ?',
+                                      (key, face_model, upsample)).fetchone()
+                self.db.execute('INSERT OR REPLACE INTO detections VALUES '
+                                '(?, ?, ?, ?, ?, ?)',
+                                (key, face_model, upsample, boxes, len(boxes),
+                                 time.time()))
+                # A replaced row no longer counts towards the total
+                self.total += len(boxes) - (old[0] if old is not None else 0)
+                self.changed()
+            except sqlite3.OperationalError:
+                self.failed()
+
+    def get_encodings(self, key, face_model, upsample, encoding_model,
+                      jitters):
+        params = (key, face_model, upsample, encoding_model, jitters)
+        with self.lock:
+            row = self.db.execute('SELECT boxes, data, dim, precision '
+                                  'FROM encodings '
+                                  'WHERE digest = ? AND face_model = ? AND '
+                                  'upsample = ? AND encoding_model = ? AND '
+                                  'jitters = ?', params).fetchone()
+            if row is None:
+                return None
+            try:
+                self.db.execute('UPDATE encodings SET last_used = ? WHERE '
+                                'digest = ? AND face_model = ? AND '
+                                'upsample = ? AND encoding_model = ? AND '
+                                'jitters = ?', (time.time(),) + params)
+                self.changed()
+            except sqlite3.OperationalError:
+                self.failed()
+        return self.unpack_boxes(row[0]), self.unpack_encodings(row[1], row[2],
+                                                                row[3])
+
+    def put_encodings(self, key, face_model, upsample, encoding_model,
+                      jitters, locs, encodings):
+        boxes = self.pack_boxes(locs)
+        encodings = np.asarray(encodings, dtype=np.float64)
+        data = self.pack_encodings(encodings)
+        size = len(boxes) + len(data)
+        params = (key, face_model, upsample, encoding_model, jitters)
+        with self.lock:
+            try:
+                old = self.db.execute('SELECT bytes FROM encodings WHERE '
+                                      'digest = ? AND face_model = ? AND '
+                                      'upsample = ? AND encoding_model = ? '
+                                      'AND jitters = ?', params).fetchone()
+                self.db.execute('INSERT OR REPLACE INTO encodings VALUES '
+                                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                params + (boxes, data, encodings.shape[-1],
+                                          size, time.time(), self.precision))
+                self.total += size - (old[0] if old is not None else 0)
+                self.changed()
+            except sqlite3.OperationalError:
+                self.failed()
+
+    def pack_boxes(self, locs):
+        return np.asarray(locs, dtype=np.int32).reshape(-1, 4).tobytes()
+
+    def unpack_boxes(self, boxes):
+        boxes = np.frombuffer(boxes, dtype=np.int32).reshape(-1, 4)
+        return [tuple(int(v) for v in box) for box in boxes]
+
+    def pack_encodings(self, encodings):
+        # int8 codes are followed by one float32 scale per face, since a
+        # few faces are too few to scale each dimension
+        encodings = encodings.reshape(len(encodings), encodings.shape[-1])
+        (codes, scale) = quantize(encodings, self.precision, axis=1)
+        data = codes.tobytes()
+        if scale is not None:
+            data += scale.tobytes()
+        return data
+
+    def unpack_encodings(self, data, dim, precision):
+        precision = precision or 'float64'
+        dtype = np.dtype(precision)
+        if precision != 'int8':
+            data = np.frombuffer(data, dtype=dtype).reshape(-1, dim)
+            return data.astype(np.float64, copy=False)
+        count = len(data)//(dim*dtype.itemsize + 4)
+        codes = np.frombuffer(data, dtype=dtype, count=count*dim).reshape(count, dim)
+        scale = np.frombuffer(data, dtype=np.float32, count=count,
+                              offset=count*dim).reshape(count, 1)
+        return dequantize(codes, scale, np.float64)
+
+    def size(self):
+        with self.lock:
+            total = 0
+            for table in ('detections', 'encodings'):
+                row = self.db.execute('SELECT SUM(bytes) FROM ' + table).fetchone()
+                total += row[0] or 0
+        return total
+
+    def changed(self):
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        with self.lock:
+            if self.total > self.max_bytes:
+                self.evict()
+            self.db.commit()
+            self.pending = 0
+
+    def failed(self):
+        # A busy or broken cache must never end a sort: the uncommitted
+        # entries are dropped and simply computed again next time
+        try:
+            self.db.rollback()
+        except sqlite3.Error:
+            pass
+        self.pending = 0
+
+    def evict(self):
+        # Drop least recently used entries from both levels until we are
+        # comfortably under the cap
+        target = int(self.max_bytes*0.9)
+        rows = self.db.execute('SELECT rowid, bytes, last_used, 0 FROM '
+                               'detections UNION ALL SELECT rowid, bytes, '
+                               'last_used, 1 FROM encodings '
+                               'ORDER BY last_used').fetchall()
+        tables = ('detections', 'encodings')
+        for (rowid, size, last_used, table) in rows:
+            if self.total <= target:
+                break
+            self.db.execute('DELETE FROM ' + tables[table] +
+                            ' WHERE rowid = ?', (rowid,))
+            self.total -= size
+        self.total = self.size()
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM detections')
+            self.db.execute('DELETE FROM encodings')
+            self.db.commit()
+            self.total = 0
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                try:
+                    self.commit()
+                except sqlite3.OperationalError:
+                    self.failed()
+                self.db.close()
+                self.db = None
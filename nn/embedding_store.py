@@ -0,0 +1,127 @@
+import os
+import json
+import pickle
+import struct
+import numpy as np
+
+# magic, format version, header length; then the JSON header, padded so
+# the matrix (float32 unless the header says otherwise) starts on an
+# ALIGN byte boundary
+MAGIC = b'BSEMB\0'
+VERSION = 1
+PREFIX = struct.Struct('<6sHI')
+ALIGN = 64
+EXTENSION = '.emb'
+LEGACY_EXTENSION = '.clf'
+
+
+class Embeddings(object):
+
+    def __init__(self, matrix, encoder, detector, labels=None, path=None):
+        self.matrix = matrix
+        self.encoder = encoder
+        self.detector = detector
+        self.labels = labels
+        self.path = path
+        self.dim = matrix.shape[1]
+
+    def __len__(self):
+        return len(self.matrix)
+
+
+def encoder_dim(encoder):
+    return 512 if encoder == '512D' else 128
+
+
+def save_embeddings(path, encodings, encoder='128D', detector='hog',
+                    labels=None, dtype='float32'):
+    matrix = np.asarray(encodings, dtype=dtype)
+    if len(matrix) == 0:
+        # No faces were found; -1 cannot be inferred from an empty array
+        matrix = np.empty((0, encoder_dim(encoder)), dtype=dtype)
+    else:
+        matrix = matrix.reshape(len(matrix), -1)
+    if labels is not None and len(labels) != len(matrix):
+        raise Exception("Expected {} labels, got {}".format(len(matrix),
+                                                           len(labels)))
+    header = json.dumps({'dim': matrix.shape[1], 'count': len(matrix),
+                         'dtype': matrix.dtype.name, 'encoder': encoder,
+                         'detector': detector,
+                         'labels': list(labels) if labels is not None else None})
+    header = header.encode('utf-8')
+    offset = PREFIX.size + len(header)
+    header += b' '*(-offset % ALIGN)
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    # Written aside and renamed, so readers never see half a file
+    temp = path + '.tmp'
+    with open(temp, 'wb') as file:
+        file.write(PREFIX.pack(MAGIC, VERSION, len(header)))
+        file.write(header)
+        file.write(np.ascontiguousarray(matrix).tobytes())
+    os.replace(temp, path)
+    return path
+
+
+def read_header(path):
+    # Returns (header dict, offset of the matrix) without reading it
+    with open(path, 'rb') as file:
+        prefix = file.read(PREFIX.size)
+        if len(prefix) < PREFIX.size:
+            raise Exception("Invalid embedding file: {}".format(path))
+        (magic, version, length) = PREFIX.unpack(prefix)
+        if magic != MAGIC:
+            raise Exception("Invalid embedding file: {}".format(path))
+        if version > VERSION:
+            raise Exception("{} was written by a newer version (format {})".format(path, version))
+        header = json.loads(file.read(length).decode('utf-8'))
+    return header, PREFIX.size + length
+
+
+def load_embeddings(path, mmap=True):
+    path = find_embeddings(path)
+    (header, offset) = read_header(path)
+    shape = (header['count'], header['dim'])
+    dtype = np.dtype(header.get('dtype', 'float32'))
+    if shape[0] == 0:
+        matrix = np.empty(shape, dtype=dtype)
+    elif mmap:
+        matrix = np.memmap(path, dtype=dtype, mode='r', offset=offset,
+                           shape=shape)
+    else:
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            matrix = np.fromfile(file, dtype=dtype,
+                                 count=shape[0]*shape[1]).reshape(shape)
+    return Embeddings(matrix, header['encoder'], header['detector'],
+                      header.get('labels'), path)
+
+
+def find_embeddings(path):
+    # The .emb file for path (with or without an extension), converting a
+    # pickled list of encodings from older versions on first use
+    base = os.path.splitext(path)[0]
+    current = base + EXTENSION
+    legacy = base + LEGACY_EXTENSION
+    if not os.path.isfile(current) and os.path.isfile(legacy):
+        with open(legacy, 'rb') as file:
+            encodings = np.asarray(pickle.load(file), dtype=np.float32)
+        encoder = '512D' if encodings.ndim == 2 and encodings.shape[1] == 512 else '128D'
+        save_embeddings(current, encodings, encoder=encoder, detector=None)
+    return current
+
+
+def has_embeddings(path):
+    base = os.path.splitext(path)[0]
+    return (os.path.isfile(base + EXTENSION) or
+            os.path.isfile(base + LEGACY_EXTENSION))
+
+
+def encoder_mismatch(path, encoder):
+    # An error message if the training data at path was not made with
+    # encoder, otherwise None
+    (header, offset) = read_header(find_embeddings(path))
+    if header['encoder'] != encoder:
+        return 'The training data is {} but model is {}; they are incompatible'.format(header['encoder'], encoder)
+    return None
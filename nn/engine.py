@@ -0,0 +1,177 @@
+import multiprocessing
+import numpy as np
+from multiprocessing import TimeoutError
+from embedding_cache import EmbeddingCache
+from utilities import FrameCache
+
+_sorter = None
+
+
+def _init_worker(sorter_class, params, cache, detection):
+    # Runs once per worker process, so models are loaded once per worker
+    # rather than once per image
+    global _sorter
+    _sorter = sorter_class()
+    _sorter.set_params(*params)
+    _sorter.set_detection(*detection)
+    _sorter.set_frames(FrameCache())
+    if cache is not None:
+        (cache_path, precision) = cache
+        # Each worker has its own connection to the same database, so it
+        # commits after every change rather than hold the write lock
+        _sorter.set_cache(EmbeddingCache(cache_path, commit_every=1,
+                                         precision=precision))
+    _sorter.warm_up()
+
+
+def _matches(sorter, image_paths, threshold, filters=None):
+    # The object filter runs over the whole chunk in one forward pass; the
+    # frames it decoded stay cached until the face pipeline is done with them
+    (classes, conf, sort_state) = filters or (None, 0.4, True)
+    utils = sorter.utils
+    matches = dict()
+    if classes:
+        images = list()
+        paths = list()
+        for image_path in image_paths:
+            (image, size) = utils.load_detection_image(image_path)
+            if image is None:
+                matches[image_path] = False
+            else:
+                images.append(image)
+                paths.append(image_path)
+        found = utils.has_objects_batch(images, conf=conf, classes=classes)
+        del images
+        for (image_path, ok) in zip(paths, found):
+            if not ok:
+                matches[image_path] = False
+                utils.release_image(image_path)
+    # The rest are encoded together, so the CNN face detector gets batches
+    remaining = [image_path for image_path in image_paths
+                 if image_path not in matches]
+    if sort_state is False:
+        for image_path in remaining:
+            matches[image_path] = True
+            utils.release_image(image_path)
+        return matches
+    encoded = utils.image_encodings(remaining,
+                                    face_model=sorter.face_model,
+                                    scaleup=sorter.upsample,
+                                    encoding_model=sorter.encoding_model,
+                                    jitters=sorter.jitters)
+    owners = list()
+    matrix = list()
+    for image_path in remaining:
+        locs, encodings = encoded[image_path]
+        owners.extend((image_path, i) for i in range(len(encodings)))
+        if len(encodings) > 0:
+            matrix.append(encodings)
+        utils.release_image(image_path)
+    matched = dict()
+    if len(owners) > 0:
+        matched = sorter.classify_embeddings(np.vstack(matrix), owners,
+                                             threshold=threshold)
+    for image_path in remaining:
+        matches[image_path] = matched.get(image_path, False)
+    return matches
+
+
+def _match_chunk(args):
+    (image_paths, threshold, filters) = args
+    matches = _matches(_sorter, image_paths, threshold, filters)
+    return [(image_path, matches[image_path]) for image_path in image_paths]
+
+
+class SortEngine(object):
+
+    def __init__(self, sorter, workers=None, chunksize=8):
+        self.sorter = sorter
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = max(1, int(workers))
+        self.chunksize = chunksize
+        self.pool = None
+        self.pool_config = None
+
+    def config(self):
+        sorter = self.sorter
+        cache = None
+        if sorter.utils.cache is not None:
+            cache = (sorter.utils.cache.path, sorter.utils.cache.precision)
+        params = (sorter.face_model, sorter.encoding_model,
+                  sorter.jitters, sorter.upsample)
+        detection = (sorter.utils.detection_pixels, sorter.utils.second_pass)
+        return (type(sorter), params, cache, detection)
+
+    def start(self):
+        config = self.config()
+        if self.pool is not None and self.pool_config == config:
+            return
+        self.close()
+        # Spawned rather than forked workers, since TensorFlow and dlib
+        # state does not survive a fork
+        context = multiprocessing.get_context('spawn')
+        self.pool = context.Pool(self.workers, initializer=_init_worker,
+                                 initargs=config)
+        self.pool_config = config
+
+    def stream(self, image_list, threshold, classes=None, conf=0.4,
+               sort_state=True, stopped=None):
+        # Yields lists of (image path, matched) in the order of image_list
+        # as soon as each chunk is done. If stopped() turns true the pool
+        # is terminated rather than left to finish its queue
+        filters = (classes, conf, sort_state)
+        jobs = [(image_list[start:start+self.chunksize], threshold, filters)
+                for start in range(0, len(image_list), self.chunksize)]
+        if self.workers == 1:
+            self.sorter.warm_up()
+            for job in jobs:
+                if stopped is not None and stopped():
+                    return
+                matches = _matches(self.sorter, *job)
+                yield [(image_path, matches[image_path])
+                       for image_path in job[0]]
+        else:
+            self.start()
+            # Release this process's write lock before the workers need it
+            if self.sorter.utils.cache is not None:
+                self.sorter.utils.cache.commit()
+            chunks = self.pool.imap(_match_chunk, jobs)
+            for i in range(len(jobs)):
+                while True:
+                    if stopped is not None and stopped():
+                        self.terminate()
+                        return
+                    try:
+                        chunk = chunks.next(timeout=0.2)
+                        break
+                    except TimeoutError:
+                        continue
+                yield chunk
+
+    def sort(self, image_list, threshold, callback=None, classes=None,
+             conf=0.4, sort_state=True):
+        # Returns [(image path, matched)] in the order of image_list
+        results = list()
+        total = len(image_list)
+        for chunk in self.stream(image_list, threshold, classes=classes,
+                                 conf=conf, sort_state=sort_state):
+            results.extend(chunk)
+            if callback is not None:
+                callback(len(results), total)
+        return results
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        self.pool = None
+        self.pool_config = None
+
+    def terminate(self):
+        # Drops queued work; the next sort starts a fresh pool
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        self.pool = None
+        self.pool_config = None
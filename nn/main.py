@@ -3,10 +3,16 @@ from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 import os
 import sys
-from shutil import copy
 from utilities import ImageUtilities as IU
+from utilities import close_facenet_encoder
+from embedding_cache import EmbeddingCache
+from engine import SortEngine
+from pipeline import SortPipeline
+from output_modes import OUTPUT_MODES
+from sort_worker import SortWorker
+from embedding_store import has_embeddings, encoder_mismatch
+from journal import RunJournal, JOURNAL_NAME
 from neural_net import NNSorter as NNS
-import pickle
 
 
 class ImageSorter(QWidget):
@@ -27,6 +33,12 @@ class ImageSorter(QWidget):
         self.sort_state = True
         self.confidence = 0.4
         self.classes = set()
+        self.cache = None
+        self.engine = None
+        self.worker = None
+        self.journal = None
+        self.output_mode = 'copy'
+        self.workers = os.cpu_count() or 1
 
         self.face_model = 'hog'
         self.encoding_model = '128D'
@@ -46,6 +58,9 @@ class ImageSorter(QWidget):
         self.button3.clicked.connect(self.advanced_options)
         self.button4 = QPushButton('Sort Images')
         self.button4.clicked.connect(self.sort_images)
+        self.button5 = QPushButton('Cancel')
+        self.button5.clicked.connect(self.cancel_sort)
+        self.button5.setEnabled(False)
 
         self.box.addWidget(self.button1)
         self.box.addWidget(self.label1)
@@ -53,6 +68,7 @@ class ImageSorter(QWidget):
         self.box.addWidget(self.label2)
         self.box.addWidget(self.button3)
         self.box.addWidget(self.button4)
+        self.box.addWidget(self.button5)
         self.box.addWidget(self.progress)
         self.box.addWidget(self.status)
 
@@ -87,7 +103,7 @@ class ImageSorter(QWidget):
             self.label2.setText(self.sort_path)
 
     def train_classifier(self):
-        if os.path.isfile('models/training_data_positive.clf') and os.path.isfile('models/training_data_negative.clf'):
+        if has_embeddings('models/training_data_positive.emb') and has_embeddings('models/training_data_negative.emb'):
             self.status.setText('Training classifier...')
             self.identifier.train()
             self.status.setText('Model trained!')
@@ -103,11 +119,13 @@ class ImageSorter(QWidget):
             self.confidence = float(self.confidence_box.text())
             self.jitters = int(self.jitter_text.text())
             self.upsample = int(self.upsamples.text())
+            self.workers = int(self.worker_text.text())
         except:
             self.threshold = 0.85
             self.confidence = 0.4
             self.jitters = 3
             self.upsample = 1
+            self.workers = os.cpu_count() or 1
 
     def detecting_objects(self, state, idx=15):
         CLASSES = ["background", "aeroplane", "bicycle", "bird", "boat",
@@ -126,10 +144,7 @@ class ImageSorter(QWidget):
                 self.detect_objects = False
 
     def set_face_detector(self, index):
-        if index == 0:
-            self.face_model = 'hog'
-        else:
-            self.face_model = 'cnn'
+        self.face_model = ['hog', 'cnn', 'cascade'][index]
 
     def set_encoding_model(self, index):
         if index == 0:
@@ -137,6 +152,9 @@ class ImageSorter(QWidget):
         else:
             self.encoding_model = '512D'
 
+    def set_output_mode(self, index):
+        self.output_mode = OUTPUT_MODES[index]
+
     def advanced_options(self):
         settings = QDialog()
         settings.setGeometry(600, 600, 300, 300)
@@ -147,10 +165,19 @@ class ImageSorter(QWidget):
         valid = QDoubleValidator()
         face_options = QComboBox()
         face_options.addItems(['HOG + SVM (faster, less accurate)',
-                               'CNN (slower, more accurate, GPU recommended)'])
+                               'CNN (slower, more accurate, GPU recommended)',
+                               'HOG, then CNN where HOG finds no faces'])
         face_options.currentIndexChanged.connect(self.set_face_detector)
-        if self.face_model == 'cnn':
-            face_options.setCurrentIndex(1)
+        output_options = QComboBox()
+        output_options.addItems(['Copy',
+                                 'Hard link (no extra space, same drive only)',
+                                 'Symbolic link',
+                                 'Reflink (copy-on-write file systems)',
+                                 'Move',
+                                 'List in manifest.txt only'])
+        output_options.setCurrentIndex(OUTPUT_MODES.index(self.output_mode))
+        output_options.currentIndexChanged.connect(self.set_output_mode)
+        face_options.setCurrentIndex(['hog', 'cnn', 'cascade'].index(self.face_model))
         conf_val = QDoubleValidator()
         conf_val.setRange(0.001, 1.00, 3)
         encoding_options = QComboBox()
@@ -169,6 +196,11 @@ class ImageSorter(QWidget):
         self.upsamples.setValidator(jitter_val)
         self.jitter_text.setText(str(self.jitters))
         self.upsamples.setText(str(self.upsample))
+        worker_val = QIntValidator()
+        worker_val.setRange(1, 256)
+        self.worker_text = QLineEdit()
+        self.worker_text.setValidator(worker_val)
+        self.worker_text.setText(str(self.workers))
         conf_label.setText('Enter the confidence level of object detection')
         filter_label = QLabel()
         filter_label.setText('Select the objects that will be used to filter images')
@@ -223,6 +255,10 @@ class ImageSorter(QWidget):
 be performed on the image')
         label4 = QLabel()
         label4.setText('Select the number of times to scale up the image')
+        label5 = QLabel()
+        label5.setText('Select the number of processes to sort with')
+        label6 = QLabel()
+        label6.setText('Select how the sorted images are saved')
         dialog = QVBoxLayout()
         dialog.addWidget(filter_label)
         dialog.addWidget(checker1)
@@ -248,6 +284,10 @@ be performed on the image')
         dialog.addWidget(self.jitter_text)
         dialog.addWidget(label4)
         dialog.addWidget(self.upsamples)
+        dialog.addWidget(label5)
+        dialog.addWidget(self.worker_text)
+        dialog.addWidget(label6)
+        dialog.addWidget(output_options)
         dialog.addWidget(button3)
         settings.setWindowTitle('Advanced Options')
         settings.setLayout(dialog)
@@ -260,6 +300,67 @@ be performed on the image')
         else:
             self.sort_state = True
 
+    def get_engine(self):
+        engine = self.engine
+        if engine is None or engine.sorter is not self.identifier or engine.workers != self.workers:
+            if engine is not None:
+                engine.close()
+            self.engine = SortEngine(self.identifier, workers=self.workers)
+        return self.engine
+
+    def update_progress(self, done, total, rate):
+        self.progress.setValue(int(100.0*done/total))
+        self.status.setText('Sorting images... {}/{} ({:.1f} images/s)'.format(done, total, rate))
+
+    def cancel_sort(self):
+        if self.worker is not None and self.worker.isRunning():
+            self.status.setText('Cancelling...')
+            self.button5.setEnabled(False)
+            self.worker.cancel()
+
+    def sort_failed(self, message):
+        error = QErrorMessage()
+        error.setWindowTitle('Error')
+        error.showMessage(message)
+        error.exec_()
+
+    def sort_finished(self):
+        self.button4.setEnabled(True)
+        self.button5.setEnabled(False)
+        if self.worker.error is not None:
+            self.status.setText('Sorting failed')
+        elif self.worker.cancelled():
+            self.status.setText('Cancelled')
+        else:
+            self.progress.setValue(100)
+            self.status.setText('Done!')
+        # A complete sort has nothing to resume; otherwise the journal is
+        # kept so the next sort with the same settings picks up from here
+        if self.journal is not None:
+            if self.worker.error is None and not self.worker.cancelled():
+                self.journal.finish()
+            else:
+                self.journal.close()
+            self.journal = None
+        self.worker = None
+
+    def get_journal(self, classes):
+        model = os.stat(self.model)
+        params = {'folder': os.path.abspath(self.folder),
+                  'model': [os.path.abspath(self.model), model.st_mtime_ns,
+                            model.st_size],
+                  'threshold': self.threshold,
+                  'face_model': self.identifier.face_model,
+                  'encoding_model': self.identifier.encoding_model,
+                  'jitters': self.identifier.jitters,
+                  'upsample': self.identifier.upsample,
+                  'classes': sorted(classes or []),
+                  'confidence': self.confidence,
+                  'sort_state': self.sort_state,
+                  'output_mode': self.output_mode}
+        return RunJournal(os.path.join(self.sort_path, JOURNAL_NAME),
+                          params).open()
+
     def sort_images(self):
         if self.folder is None or self.sort_path is None:
             error = QErrorMessage()
@@ -267,18 +368,13 @@ be performed on the image')
             error.showMessage('One or more paths have not been set')
             error.exec_()
         elif os.path.isfile(self.model):
-            if os.path.isfile('models/training_data_positive.clf') and os.path.isfile('models/training_data_negative.clf'):
-                with open('models/training_data_positive.clf', 'rb') as file:
-                    data = pickle.load(file)
-                if 512 in data[0].shape and self.encoding_model == '128D':
-                    error = QErrorMessage()
-                    error.setWindowTitle('Error')
-                    error.showMessage('The training data is 512D but model is 128D; they are incompatible')
-                    error.exec_()
-                elif 128 in data[0].shape and self.encoding_model == '512D':
+            if has_embeddings('models/training_data_positive.emb') and has_embeddings('models/training_data_negative.emb'):
+                message = encoder_mismatch('models/training_data_positive.emb',
+                                           self.encoding_model)
+                if message is not None:
                     error = QErrorMessage()
                     error.setWindowTitle('Error')
-                    error.showMessage('The training data is 128D but model is 512D; they are incompatible')
+                    error.showMessage(message)
                     error.exec_()
                 else:                    
                     self.progress.setValue(0)
@@ -286,43 +382,34 @@ be performed on the image')
                                                self.encoding_model,
                                                self.jitters,
                                                self.upsample)
+                    if self.cache is None:
+                        self.cache = EmbeddingCache()
+                    self.identifier.set_cache(self.cache)
                     self.identifier.set_folder(self.folder)
                     image_list = self.identifier.get_image_list()
                     image_list.sort()
-                    results = list()
+                    self.status.setText('Sorting images...')
+                    engine = None
+                    if self.workers > 1:
+                        engine = self.get_engine()
+                    classes = None
                     if self.detect_objects is True:
-                        self.status.setText('Filtering images...')
-                        utils = IU()
-                        image_list = utils.detect_objects(image_list,
-                                                          bar=self.progress,
-                                                          classes=self.classes,
-                                                          conf=self.confidence)
-                    if self.sort_state is True:
-                        increment = float(100.00/float(len(image_list)))
-                        self.progress.setValue(0)
-                        done = 0
-                        self.status.setText('Sorting images...')
-                        for image in image_list:
-                            result = self.identifier.predict(image_path = image,
-                                                             threshold = self.threshold)
-                            if result is True:
-                                results.append(image)
-                            done += increment
-                            self.progress.setValue(done)
-                        self.progress.setValue(100)
-                    else:
-                        results = image_list
-                    if not os.path.exists(self.sort_path):
-                        os.makedirs(self.sort_path)
-                    self.progress.setValue(0); done = 0;
-                    self.status.setText('Copying results to folder...')
-                    increment = float(len(results) / 100.0)
-                    for image in results:
-                        copy(image, self.sort_path)
-                        done += increment
-                        self.progress.setValue(done)
-                    self.progress.setValue(100)
-                    self.status.setText('Done!')
+                        classes = self.classes
+                    self.journal = self.get_journal(classes)
+                    pipeline = SortPipeline(self.identifier, self.sort_path,
+                                            self.threshold, classes=classes,
+                                            conf=self.confidence,
+                                            sort_state=self.sort_state,
+                                            engine=engine,
+                                            output_mode=self.output_mode,
+                                            journal=self.journal)
+                    self.worker = SortWorker(pipeline, image_list)
+                    self.worker.progress.connect(self.update_progress)
+                    self.worker.failed.connect(self.sort_failed)
+                    self.worker.finished.connect(self.sort_finished)
+                    self.button4.setEnabled(False)
+                    self.button5.setEnabled(True)
+                    self.worker.start()
             else:
                 error = QErrorMessage()
                 error.setWindowTitle('Error')
@@ -339,7 +426,18 @@ def main():
     app = QApplication(sys.argv)
     UI = ImageSorter()
     UI.show()
-    sys.exit(app.exec_())
+    status = app.exec_()
+    if UI.worker is not None:
+        UI.worker.cancel()
+        UI.worker.wait()
+    if UI.journal is not None:
+        UI.journal.close()
+    if UI.engine is not None:
+        UI.engine.close()
+    if UI.cache is not None:
+        UI.cache.close()
+    close_facenet_encoder()
+    sys.exit(status)
 
 if __name__ == '__main__':
     main()
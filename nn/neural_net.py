@@ -1,12 +1,11 @@
 from keras.models import Sequential, load_model
 from keras.layers import Dense, Dropout
 import numpy as np
-import cv2
 import os
 import sys
 import re
-import pickle
 from utilities import ImageUtilities as IU
+from embedding_store import load_embeddings
 
 class NNSorter(object):
 
@@ -23,6 +22,8 @@ class NNSorter(object):
         self.jitters = 3
         self.upsample = 1
         self.hidden = hidden
+        self.model = None
+        self.model_signature = None
 
     def set_folder(self, folder):
         self.folder = folder
@@ -33,6 +34,36 @@ class NNSorter(object):
         self.jitters = jitters
         self.upsample = upsample
 
+    def warm_up(self):
+        self.load()
+        self.utils.warm_up(model=self.encoding_model)
+
+    def set_cache(self, cache):
+        self.utils.cache = cache
+
+    def set_frames(self, frames):
+        self.utils.frames = frames
+
+    def set_detection(self, pixels, second_pass=True):
+        self.utils.detection_pixels = pixels
+        self.utils.second_pass = second_pass
+
+    def encode(self, image_path):
+        return self.utils.image_encodings([image_path],
+                                          face_model=self.face_model,
+                                          scaleup=self.upsample,
+                                          encoding_model=self.encoding_model,
+                                          jitters=self.jitters)[image_path]
+
+    def load(self, model_path='models/predictor_NN_model.h5'):
+        # Keep the Keras model resident; reload only if it was retrained
+        stat = os.stat(model_path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if self.model is None or self.model_signature != signature:
+            self.model = load_model(model_path)
+            self.model_signature = signature
+        return self.model
+
     def train(self):
         model = Sequential()
         model.add(Dense(self.neurons+4, input_dim=self.neurons,
@@ -43,12 +74,10 @@ class NNSorter(object):
         model.compile(loss='binary_crossentropy',
                       optimizer='adam',
                       metrics=['accuracy'])
-        with open('models/training_data_positive.clf', 'rb') as file:
-            X = pickle.load(file)
-        data1 = np.vstack(X)
-        with open('models/training_data_negative.clf', 'rb') as file:
-            X1 = pickle.load(file)
-        data2 = np.vstack(X1)
+        X = load_embeddings('models/training_data_positive.emb').matrix
+        data1 = np.asarray(X)
+        X1 = load_embeddings('models/training_data_negative.emb').matrix
+        data2 = np.asarray(X1)
         data = np.vstack((data1, data2))
         y = list()
         for i in range(len(X)):
@@ -58,36 +87,61 @@ class NNSorter(object):
         y = np.asarray(y)
         model.fit(data, y, epochs=199, batch_size=5)
         model.save('models/predictor_NN_model.h5')
+        stat = os.stat('models/predictor_NN_model.h5')
+        self.model = model
+        self.model_signature = (stat.st_mtime_ns, stat.st_size)
 
         return model
 
     def predict(self, image_path, threshold=0.85):
-        utils = IU()
-        model = load_model('models/predictor_NN_model.h5')
-        image = cv2.imread(image_path)
-        locs = utils.get_face_locations(image=image,
-                                        model=self.face_model,
-                                        scaleup=self.upsample)
-        encodings = list()
-        for (sX, sY, eX, eY) in locs:
-            face = cv2.resize(image[sY:eY, sX:eX], (160, 160))
-            encoding = utils.face_encodings(face,
-                                            model=self.encoding_model,
-                                            jitters=self.jitters)
-            if len(encoding) == 0:
-                continue
-            else:
-                encodings.append(encoding[0])
+        model = self.load()
+        locs, encodings = self.encode(image_path)
         if len(encodings) == 0:
             return False
-        data = np.vstack(encodings)
-        predictions = model.predict(data)
+        predictions = model.predict(encodings)
         for prediction in predictions:
             if prediction[0] > threshold:
                 return True
 
         return False
 
+    def match(self, image_path, threshold=0.85):
+        return self.predict(image_path, threshold=threshold) is True
+
+    def match_encodings(self, encodings, threshold=0.85):
+        if len(encodings) == 0:
+            return False
+        return bool((self.face_scores(encodings) > threshold).any())
+
+    def face_scores(self, matrix):
+        return self.load().predict(matrix, batch_size=256)[:, 0]
+
+    def classify_embeddings(self, matrix, owners, threshold=0.85):
+        # Scores every face of many images in one predict call; returns
+        # {image: matched} for each image in owners
+        if len(owners) == 0:
+            return dict()
+        scores = self.utils.group_max(owners, self.face_scores(matrix))
+        return dict((image, bool(score > threshold))
+                    for (image, score) in scores.items())
+
+    def predict_many(self, image_paths, threshold=0.85, batch_size=32):
+        encodings, owners = self.utils.encode_images(
+            image_paths,
+            face_model=self.face_model,
+            scaleup=self.upsample,
+            encoding_model=self.encoding_model,
+            jitters=self.jitters,
+            batch_size=batch_size)
+        scores = dict((image_path, 0.0) for image_path in image_paths)
+        if len(owners) > 0:
+            for (image_path, score) in self.utils.group_max(
+                    owners, self.face_scores(encodings)).items():
+                scores[image_path] = max(0.0, float(score))
+
+        return [(scores[image_path] > threshold, scores[image_path])
+                for image_path in image_paths]
+
     def get_image_list(self):
         images_list = list()
         try:
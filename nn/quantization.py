@@ -0,0 +1,73 @@
+import numpy as np
+
+# Storage precisions for embeddings; int8 codes come with float32 scales
+PRECISIONS = ('float64', 'float32', 'float16', 'int8')
+
+
+def check_precision(precision):
+    if precision not in PRECISIONS:
+        raise Exception("Invalid precision: {}".format(precision))
+
+
+def quantize(matrix, precision='float32', axis=0):
+    # Returns (codes, scale). int8 codes are scaled per dimension (axis=0,
+    # for galleries) or per row (axis=1, for a few faces at a time); the
+    # other precisions are plain casts with no scale
+    check_precision(precision)
+    if precision != 'int8':
+        return np.ascontiguousarray(matrix, dtype=precision), None
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.size == 0:
+        shape = (1, matrix.shape[1]) if axis == 0 else (len(matrix), 1)
+        return matrix.astype(np.int8), np.ones(shape, dtype=np.float32)
+    peak = np.abs(matrix).max(axis=axis, keepdims=True)
+    scale = np.where(peak > 0, peak/127.0, 1.0).astype(np.float32)
+    codes = np.clip(np.rint(matrix/scale), -127, 127).astype(np.int8)
+    return codes, scale
+
+
+def dequantize(codes, scale, dtype=np.float32):
+    values = np.asarray(codes).astype(dtype)
+    if scale is not None:
+        values *= scale
+    return values
+
+
+def nbytes(codes, scale):
+    return codes.nbytes + (0 if scale is None else scale.nbytes)
+
+
+def products(queries, codes, scale=None, block=4096):
+    # queries . dequantize(codes).T. A per-dimension scale is folded into
+    # the queries, and the codes are widened a block at a time, so the
+    # full precision matrix never exists
+    if codes.dtype == np.float64:
+        return np.dot(np.asarray(queries, dtype=np.float64), codes.T)
+    queries = np.asarray(queries, dtype=np.float32)
+    if scale is not None:
+        queries = queries*scale
+    if codes.dtype == np.float32:
+        return np.dot(queries, codes.T)
+    result = np.empty((len(queries), len(codes)), dtype=np.float32)
+    for start in range(0, len(codes), block):
+        chunk = codes[start:start+block].astype(np.float32)
+        result[:, start:start+len(chunk)] = np.dot(queries, chunk.T)
+    return result
+
+
+def squared_norms(codes, scale=None, block=4096):
+    dtype = np.float64 if codes.dtype == np.float64 else np.float32
+    norms = np.empty(len(codes), dtype=dtype)
+    for start in range(0, len(codes), block):
+        chunk = dequantize(codes[start:start+block], scale, dtype)
+        norms[start:start+len(chunk)] = np.einsum('ij,ij->i', chunk, chunk)
+    return norms
+
+
+def squared_distances(queries, codes, scale=None, norms=None):
+    # (queries, rows) squared Euclidean distances to the quantised rows
+    if norms is None:
+        norms = squared_norms(codes, scale)
+    queries = np.asarray(queries, dtype=norms.dtype)
+    return (np.einsum('ij,ij->i', queries, queries)[:, None] + norms[None, :]
+            - 2*products(queries, codes, scale))
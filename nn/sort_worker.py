@@ -0,0 +1,37 @@
+import time
+from PyQt5.QtCore import QThread, pyqtSignal
+
+
+class SortWorker(QThread):
+
+    progress = pyqtSignal(int, int, float)
+    result = pyqtSignal(str, object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, pipeline, image_list, parent=None):
+        super(SortWorker, self).__init__(parent)
+        self.pipeline = pipeline
+        self.image_list = image_list
+        self.results = list()
+        self.error = None
+        self.start_time = None
+
+    def run(self):
+        self.start_time = time.time()
+        try:
+            self.results = self.pipeline.run(self.image_list,
+                                             callback=self.report,
+                                             on_result=self.result.emit)
+        except Exception as e:
+            self.error = str(e)
+            self.failed.emit(self.error)
+
+    def report(self, done, total):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        self.progress.emit(done, total, done/elapsed)
+
+    def cancel(self):
+        self.pipeline.cancel()
+
+    def cancelled(self):
+        return self.pipeline.cancelled.is_set()
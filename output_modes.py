@@ -0,0 +1,137 @@
+import os
+import errno
+import shutil
+import threading
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl(dest_fd, FICLONE, src_fd) shares the source's extents on Btrfs,
+# XFS and other copy-on-write filesystems
+FICLONE = 0x40049409
+
+OUTPUT_MODES = ['copy', 'hardlink', 'symlink', 'reflink', 'move', 'manifest']
+
+# Errors meaning "this filesystem/target can't do that", not real failures
+_FALLBACK_ERRORS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EINVAL,
+                    errno.ENOTTY, errno.EOPNOTSUPP, errno.ENOSYS)
+
+
+class OutputWriter(object):
+
+    def __init__(self, sort_path, mode='copy', manifest_name='manifest.txt'):
+        if mode not in OUTPUT_MODES:
+            raise Exception("Invalid output mode: {}".format(mode))
+        self.sort_path = sort_path
+        self.mode = mode
+        self.manifest_path = os.path.join(sort_path, manifest_name)
+        self.manifest_name = manifest_name
+        self.manifest_file = None
+        self.children = dict()
+        self.lock = threading.Lock()
+
+    def open(self):
+        if not os.path.exists(self.sort_path):
+            os.makedirs(self.sort_path)
+        if self.mode == 'manifest' and self.manifest_file is None:
+            self.manifest_file = open(self.manifest_path, 'a')
+
+    def write(self, image_path):
+        target = os.path.join(self.sort_path, os.path.basename(image_path))
+        if os.path.abspath(image_path) == os.path.abspath(target):
+            return target
+        if self.mode == 'manifest':
+            with self.lock:
+                self.manifest_file.write(os.path.abspath(image_path) + '\n')
+                self.manifest_file.flush()
+            return self.manifest_path
+        getattr(self, self.mode)(image_path, target)
+        return target
+
+    def child(self, folder):
+        # A writer for a sub-folder, e.g. one per person; the name must not
+        # reach outside the results folder
+        if (not folder or os.path.basename(folder) != folder or
+                '\\' in folder or folder.startswith('.')):
+            raise Exception("Invalid folder name: {}".format(folder))
+        with self.lock:
+            writer = self.children.get(folder)
+            if writer is None:
+                writer = OutputWriter(os.path.join(self.sort_path, folder),
+                                      self.mode, self.manifest_name)
+                writer.open()
+                self.children[folder] = writer
+        return writer
+
+    def route(self, image_path, folders):
+        # Writes an image into several sub-folders; when moving, it is
+        # copied to all but the last so every folder gets it
+        targets = list()
+        for i, folder in enumerate(folders):
+            writer = self.child(folder)
+            if self.mode == 'move' and i < len(folders) - 1:
+                target = os.path.join(writer.sort_path,
+                                      os.path.basename(image_path))
+                writer.copy(image_path, target)
+            else:
+                target = writer.write(image_path)
+            targets.append(target)
+        return targets
+
+    def copy(self, image_path, target):
+        # A link left by an earlier hardlink or symlink run is the same
+        # file as the image, which shutil refuses to copy over
+        if os.path.abspath(image_path) == os.path.abspath(target):
+            return
+        self.remove(target)
+        shutil.copy(image_path, target)
+
+    def move(self, image_path, target):
+        if os.path.abspath(image_path) == os.path.abspath(target):
+            return
+        self.remove(target)
+        shutil.move(image_path, target)
+
+    def hardlink(self, image_path, target):
+        self.remove(target)
+        try:
+            os.link(image_path, target)
+        except OSError as e:
+            # Cross-device or unsupported; the copier threads still give
+            # us a parallel copy
+            if e.errno not in _FALLBACK_ERRORS:
+                raise
+            shutil.copy(image_path, target)
+
+    def symlink(self, image_path, target):
+        self.remove(target)
+        os.symlink(os.path.abspath(image_path), target)
+
+    def reflink(self, image_path, target):
+        self.remove(target)
+        if fcntl is None:
+            shutil.copy(image_path, target)
+            return
+        try:
+            with open(image_path, 'rb') as src, open(target, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copymode(image_path, target)
+        except (IOError, OSError) as e:
+            if e.errno not in _FALLBACK_ERRORS:
+                raise
+            shutil.copy(image_path, target)
+
+    def remove(self, target):
+        # Match shutil.copy, which overwrites an existing file of that name
+        if os.path.lexists(target):
+            os.remove(target)
+
+    def close(self):
+        with self.lock:
+            for writer in self.children.values():
+                writer.close()
+            self.children.clear()
+            if self.manifest_file is not None:
+                self.manifest_file.close()
+                self.manifest_file = None
@@ -0,0 +1,337 @@
+import os
+import queue
+import threading
+import numpy as np
+from output_modes import OutputWriter
+
+_DONE = object()
+
+
+class Job(object):
+
+    def __init__(self, index, image_path):
+        self.index = index
+        self.image_path = image_path
+        self.key = None
+        self.image = None
+        self.size = None
+        self.crops = None
+        self.locs = None
+        self.encodings = None
+        self.matched = None
+
+
+class Stage(object):
+
+    def __init__(self, pipeline, func, inbox, outbox, workers=1):
+        self.pipeline = pipeline
+        self.func = func
+        self.inbox = inbox
+        self.outbox = outbox
+        self.remaining = workers
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.work, daemon=True)
+                        for i in range(workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def work(self):
+        while True:
+            item = self.inbox.get()
+            if item is _DONE:
+                # Let sibling workers of this stage see the sentinel too
+                self.inbox.put(_DONE)
+                break
+            if self.pipeline.stopped():
+                continue
+            try:
+                for result in self.func(item):
+                    if self.outbox is not None:
+                        self.outbox.put(result)
+            except Exception as e:
+                self.pipeline.fail(e)
+        with self.lock:
+            self.remaining -= 1
+            last = self.remaining == 0
+        if last and self.outbox is not None:
+            self.outbox.put(_DONE)
+
+
+class SortPipeline(object):
+
+    def __init__(self, sorter, sort_path, threshold, classes=None, conf=0.4,
+                 sort_state=True, decoders=2, detectors=None, copiers=2,
+                 batch_size=32, queue_size=16, engine=None,
+                 output_mode='copy', journal=None):
+        self.sorter = sorter
+        self.journal = journal
+        self.engine = engine
+        self.utils = sorter.utils
+        self.sort_path = sort_path
+        self.output = OutputWriter(sort_path, mode=output_mode)
+        self.threshold = threshold
+        self.classes = classes
+        self.conf = conf
+        self.sort_state = sort_state
+        self.decoders = decoders
+        if detectors is None:
+            detectors = os.cpu_count() or 1
+        self.detectors = detectors
+        self.copiers = copiers
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.cancelled = threading.Event()
+        self.error = None
+        self.lock = threading.Lock()
+
+    def stopped(self):
+        return self.cancelled.is_set() or self.error is not None
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def fail(self, error):
+        with self.lock:
+            if self.error is None:
+                self.error = error
+
+    def drop(self, job):
+        job.image = None
+        self.utils.release_image(job.image_path)
+
+    def decode(self, job):
+        sorter = self.sorter
+        # As in engine._matches: without an object filter there is nothing
+        # to check when faces are not being sorted, and cached encodings
+        # must not be classified either
+        if self.sort_state is False and not self.classes:
+            job.matched = True
+            yield job
+            return
+        cache = self.utils.cache
+        if cache is not None:
+            job.key = cache.file_key(job.image_path)
+            if not self.classes:
+                cached = cache.get_encodings(job.key,
+                                             self.utils.detector_key(sorter.face_model),
+                                             sorter.upsample,
+                                             sorter.encoding_model,
+                                             sorter.jitters)
+                if cached is not None:
+                    (job.locs, job.encodings) = cached
+                    yield job
+                    return
+        (job.image, job.size) = self.utils.load_detection_image(job.image_path)
+        if job.image is None:
+            job.matched = False
+        yield job
+
+    def detect(self, job):
+        sorter = self.sorter
+        if job.matched is not None or job.encodings is not None:
+            yield job
+            return
+        if self.classes:
+            if not self.utils.has_objects(job.image,
+                                          conf=self.conf,
+                                          classes=self.classes):
+                job.matched = False
+                self.drop(job)
+                yield job
+                return
+        if self.sort_state is False:
+            job.matched = True
+            self.drop(job)
+            yield job
+            return
+        job.locs = self.utils.detect_faces(job.image_path, image=job.image,
+                                           face_model=sorter.face_model,
+                                           scaleup=sorter.upsample,
+                                           key=job.key, size=job.size)
+        job.crops = self.utils.face_crops(job.image_path, job.locs,
+                                          image=job.image, size=job.size)
+        self.drop(job)
+        yield job
+
+    def encode(self, jobs):
+        # Encodes the faces of a batch of jobs in one call, then classifies
+        # each image from its encodings
+        sorter = self.sorter
+        crops = list()
+        for job in jobs:
+            if job.matched is None and job.encodings is None:
+                for i, crop in enumerate(job.crops):
+                    crops.append((job, i, crop))
+        encodings, owners = self.utils.face_encodings_batch(
+            crops,
+            model=sorter.encoding_model,
+            batch_size=self.batch_size,
+            jitters=sorter.jitters)
+        rows = dict()
+        for row, (job, i) in enumerate(owners):
+            rows.setdefault(job.index, list()).append((i, row))
+        for job in jobs:
+            if job.matched is None and job.encodings is None:
+                picked = rows.get(job.index, list())
+                job.locs = [job.locs[i] for (i, row) in picked]
+                job.encodings = encodings[[row for (i, row) in picked]]
+                if self.utils.cache is not None:
+                    self.utils.cache.put_encodings(job.key,
+                                                   self.utils.detector_key(sorter.face_model),
+                                                   sorter.upsample,
+                                                   sorter.encoding_model,
+                                                   sorter.jitters,
+                                                   job.locs, job.encodings)
+            job.crops = None
+        # One vectorised classification for every face in the batch
+        pending = [job for job in jobs if job.matched is None]
+        owners = [(job.index, i) for job in pending
+                  for i in range(len(job.encodings))]
+        matched = dict()
+        if len(owners) > 0:
+            matrix = np.vstack([job.encodings for job in pending
+                                if len(job.encodings) > 0])
+            matched = sorter.classify_embeddings(matrix, owners,
+                                                 threshold=self.threshold)
+        for job in jobs:
+            if job.matched is None:
+                job.matched = matched.get(job.index, False)
+            yield job
+
+    def batches(self, inbox, outbox):
+        # Groups whatever is ready into batches of up to batch_size jobs,
+        # so a slow producer never holds results back
+        done = False
+        while not done:
+            jobs = [inbox.get()]
+            while len(jobs) < self.batch_size:
+                try:
+                    jobs.append(inbox.get_nowait())
+                except queue.Empty:
+                    break
+            if _DONE in jobs:
+                jobs.remove(_DONE)
+                done = True
+            if self.stopped():
+                continue
+            try:
+                for job in self.encode(jobs):
+                    outbox.put(job)
+            except Exception as e:
+                self.fail(e)
+        outbox.put(_DONE)
+
+    def store(self, job):
+        # matched is True/False, or the names of the people found by a
+        # gallery sorter, each of whom gets a folder of their own
+        signature = None
+        if self.journal is not None:
+            signature = self.journal.signature(job.image_path)
+        if job.matched is True:
+            self.output.write(job.image_path)
+        elif job.matched:
+            self.output.route(job.image_path, job.matched)
+        # Only once its output is written is an image done
+        if self.journal is not None:
+            self.journal.record(job.image_path, job.matched, signature)
+        yield job
+
+    def compute(self, todo, outbox):
+        # Process mode: the engine's workers decode, detect, encode and
+        # classify, and this thread hands their results to the copiers
+        try:
+            indexes = iter([index for (index, image_path) in todo])
+            for chunk in self.engine.stream([image_path for (index, image_path)
+                                             in todo],
+                                            self.threshold,
+                                            classes=self.classes,
+                                            conf=self.conf,
+                                            sort_state=self.sort_state,
+                                            stopped=self.stopped):
+                for (image_path, matched) in chunk:
+                    job = Job(next(indexes), image_path)
+                    job.matched = matched
+                    outbox.put(job)
+        except Exception as e:
+            self.fail(e)
+        outbox.put(_DONE)
+
+    def feed(self, todo, outbox):
+        for (index, image_path) in todo:
+            if self.stopped():
+                break
+            outbox.put(Job(index, image_path))
+        outbox.put(_DONE)
+
+    def run(self, image_paths, callback=None, on_result=None):
+        # Returns [(image path, matched)] in the order of image_paths;
+        # matching images are written to sort_path as soon as they are found.
+        # callback(done, total) and on_result(image path, matched) are
+        # always called from the calling thread
+        self.output.open()
+        self.cancelled.clear()
+        self.error = None
+        total = len(image_paths)
+        # Images a journal says are already done are not sorted again
+        results = list()
+        todo = list()
+        for (index, image_path) in enumerate(image_paths):
+            matched = None
+            if self.journal is not None:
+                matched = self.journal.completed(image_path)
+            if matched is None:
+                todo.append((index, image_path))
+            else:
+                results.append((index, image_path, matched))
+        if callback is not None and len(results) > 0:
+            callback(len(results), total)
+        matches = queue.Queue(self.queue_size)
+        finished = queue.Queue()
+        stages = [Stage(self, self.store, matches, finished, self.copiers)]
+        if self.engine is not None:
+            threads = [threading.Thread(target=self.compute,
+                                        args=(todo, matches),
+                                        daemon=True)]
+        else:
+            paths = queue.Queue(self.queue_size)
+            frames = queue.Queue(self.queue_size)
+            faces = queue.Queue(self.queue_size)
+            stages.append(Stage(self, self.decode, paths, frames,
+                                self.decoders))
+            stages.append(Stage(self, self.detect, frames, faces,
+                                self.detectors))
+            threads = [threading.Thread(target=self.batches,
+                                        args=(faces, matches), daemon=True),
+                       threading.Thread(target=self.feed,
+                                        args=(todo, paths),
+                                        daemon=True)]
+        for stage in stages:
+            stage.start()
+        for thread in threads:
+            thread.start()
+        while True:
+            job = finished.get()
+            if job is _DONE:
+                break
+            results.append((job.index, job.image_path, job.matched))
+            if on_result is not None:
+                on_result(job.image_path, job.matched)
+            if callback is not None:
+                callback(len(results), total)
+        for stage in stages:
+            stage.join()
+        for thread in threads:
+            thread.join()
+        self.output.close()
+        if self.error is not None:
+            raise self.error
+        results.sort()
+
+        return [(image_path, matched)
+                for (index, image_path, matched) in results]
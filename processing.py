@@ -1,5 +1,4 @@
 import os
-import cv2
 import sys
 import re
 import math
@@ -7,6 +6,33 @@ import pickle
 import numpy as np
 from sklearn import neighbors, svm
 from utilities import ImageUtilities as IU
+from utilities import PEOPLE_DIR
+from gallery_index import make_index
+from embedding_store import load_embeddings, find_embeddings, save_embeddings
+
+
+class ClassifierCache(object):
+
+    def __init__(self):
+        self.models = dict()
+
+    def load(self, model_path):
+        # Reload only when the file on disk changes, e.g. after train()
+        stat = os.stat(model_path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self.models.get(model_path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        with open(model_path, 'rb') as f:
+            model = pickle.load(f)
+        self.models[model_path] = (signature, model)
+        return model
+
+    def clear(self):
+        self.models.clear()
+
+
+classifiers = ClassifierCache()
 
 
 class KNNSorter(object):
@@ -28,12 +54,31 @@ class KNNSorter(object):
         self.jitters = jitters
         self.upsample = upsample
 
+    def warm_up(self):
+        self.utils.warm_up(model=self.encoding_model)
+
+    def set_cache(self, cache):
+        self.utils.cache = cache
+
+    def set_frames(self, frames):
+        self.utils.frames = frames
+
+    def set_detection(self, pixels, second_pass=True):
+        self.utils.detection_pixels = pixels
+        self.utils.second_pass = second_pass
+
+    def encode(self, image_path):
+        return self.utils.image_encodings([image_path],
+                                          face_model=self.face_model,
+                                          scaleup=self.upsample,
+                                          encoding_model=self.encoding_model,
+                                          jitters=self.jitters)[image_path]
+
     def train(self, n_neighbors=None, knn_algo='ball_tree'):
         X = []
         y = []
         model_save_path = "models/predictor_knn_model.clf"
-        with open('models/training_data.clf', 'rb') as file:
-            X = pickle.load(file)
+        X = load_embeddings('models/training_data.emb').matrix
         for i in range(len(X)):
             y.append('search_face')
         if n_neighbors is None:
@@ -54,25 +99,39 @@ class KNNSorter(object):
         if knn_clf is None and model_path is None:
             raise Exception("Must supply knn classifier either through knn_clf or model_path")
         if knn_clf is None:
-            with open(model_path, 'rb') as f:
-                knn_clf = pickle.load(f)
-        X_img = cv2.imread(image_path)
-        X_face_locations = self.utils.get_face_locations(image=X_img,
-                                                         model=self.face_model,
-                                                         scaleup=self.upsample)
+            knn_clf = classifiers.load(model_path)
+        X_face_locations, faces_encodings = self.encode(image_path)
         if len(X_face_locations) == 0:
             return []
-        faces_encodings = list()
-        for (x, y, a, b) in X_face_locations:
-            face = X_img[y:b, x:a]
-            encode = self.utils.face_encodings(face,
-                                               model=self.encoding_model,
-                                               jitters=self.jitters)
-            faces_encodings.append(encode[0])
         closest_distances = knn_clf.kneighbors(faces_encodings, n_neighbors=1)
         are_matches = [closest_distances[0][i][0] <= threshold for i in range(len(X_face_locations))]
         return [(pred, loc) if rec else ("unknown", loc) for pred, loc, rec in zip(knn_clf.predict(faces_encodings), X_face_locations, are_matches)]
 
+    def match(self, image_path, threshold=0.6):
+        locs, faces_encodings = self.encode(image_path)
+        return self.match_encodings(faces_encodings, threshold=threshold)
+
+    def match_encodings(self, faces_encodings, threshold=0.6, knn_clf=None):
+        if len(faces_encodings) == 0:
+            return False
+        return bool(self.face_hits(faces_encodings, threshold, knn_clf).any())
+
+    def face_hits(self, matrix, threshold=0.6, knn_clf=None):
+        if knn_clf is None:
+            knn_clf = classifiers.load("models/predictor_knn_model.clf")
+        closest_distances = knn_clf.kneighbors(matrix, n_neighbors=1)[0][:, 0]
+        predictions = np.char.lower(knn_clf.predict(matrix).astype(str))
+        return (closest_distances <= threshold) & (predictions == 'search_face')
+
+    def classify_embeddings(self, matrix, owners, threshold=0.6):
+        # Classifies every face of many images at once; returns
+        # {image: matched} for each image in owners
+        if len(owners) == 0:
+            return dict()
+        hits = self.face_hits(matrix, threshold)
+        return dict((image, bool(best > 0)) for (image, best)
+                    in self.utils.group_max(owners, hits).items())
+
     def get_image_list(self):
         images_list = list()
         try:
@@ -105,12 +164,31 @@ class SVMSorter(object):
         self.jitters = jitters
         self.upsample = upsample
 
+    def warm_up(self):
+        self.utils.warm_up(model=self.encoding_model)
+
+    def set_cache(self, cache):
+        self.utils.cache = cache
+
+    def set_frames(self, frames):
+        self.utils.frames = frames
+
+    def set_detection(self, pixels, second_pass=True):
+        self.utils.detection_pixels = pixels
+        self.utils.second_pass = second_pass
+
+    def encode(self, image_path):
+        return self.utils.image_encodings([image_path],
+                                          face_model=self.face_model,
+                                          scaleup=self.upsample,
+                                          encoding_model=self.encoding_model,
+                                          jitters=self.jitters)[image_path]
+
     def train(self):
         X = []
         y = []
         model_save_path = "models/predictor_svm_model.clf"
-        with open('models/training_data.clf', 'rb') as file:
-            X = pickle.load(file)
+        X = load_embeddings('models/training_data.emb').matrix
         for i in range(len(X)):
             y.append('search_face')
         svm_clf = svm.OneClassSVM()
@@ -129,27 +207,40 @@ class SVMSorter(object):
         if svm_clf is None and model_path is None:
             raise Exception("Must supply svm classifier either through svm_clf or model_path")
         if svm_clf is None:
-            with open(model_path, 'rb') as f:
-                svm_clf = pickle.load(f)
-        X_img = cv2.imread(image_path)
-        X_face_locations = self.utils.get_face_locations(image=X_img,
-                                                         model=self.face_model,
-                                                         scaleup=self.upsample)
+            svm_clf = classifiers.load(model_path)
+        X_face_locations, faces_encodings = self.encode(image_path)
         if len(X_face_locations) == 0:
             return False
-        faces_encodings = list()
-        for (x, y, a, b) in X_face_locations:
-            face = X_img[y:b, x:a]
-            encode = self.utils.face_encodings(face,
-                                               model=self.encoding_model,
-                                               jitters=self.jitters)
-            faces_encodings.append(encode[0])
         distances = svm_clf.decision_function(faces_encodings)
         for distance in distances:
             if distance < threshold or distance > 0:
                 return True
         return False
 
+    def match(self, image_path, threshold=0.006):
+        locs, faces_encodings = self.encode(image_path)
+        return self.match_encodings(faces_encodings, threshold=threshold)
+
+    def match_encodings(self, faces_encodings, threshold=0.006, svm_clf=None):
+        if len(faces_encodings) == 0:
+            return False
+        return bool(self.face_hits(faces_encodings, threshold, svm_clf).any())
+
+    def face_hits(self, matrix, threshold=0.006, svm_clf=None):
+        if threshold > 0:
+            threshold *= -1
+        if svm_clf is None:
+            svm_clf = classifiers.load("models/predictor_svm_model.clf")
+        distances = np.ravel(svm_clf.decision_function(matrix))
+        return (distances < threshold) | (distances > 0)
+
+    def classify_embeddings(self, matrix, owners, threshold=0.006):
+        if len(owners) == 0:
+            return dict()
+        hits = self.face_hits(matrix, threshold)
+        return dict((image, bool(best > 0)) for (image, best)
+                    in self.utils.group_max(owners, hits).items())
+
     def get_image_list(self):
         images_list = list()
         try:
@@ -182,11 +273,29 @@ class EuclideanSorter(object):
         self.jitters = jitters
         self.upsample = upsample
 
+    def warm_up(self):
+        self.utils.warm_up(model=self.encoding_model)
+
+    def set_cache(self, cache):
+        self.utils.cache = cache
+
+    def set_frames(self, frames):
+        self.utils.frames = frames
+
+    def set_detection(self, pixels, second_pass=True):
+        self.utils.detection_pixels = pixels
+        self.utils.second_pass = second_pass
+
+    def encode(self, image_path):
+        return self.utils.image_encodings([image_path],
+                                          face_model=self.face_model,
+                                          scaleup=self.upsample,
+                                          encoding_model=self.encoding_model,
+                                          jitters=self.jitters)[image_path]
+
     def train(self):
         model_save_path = "models/predictor_euclidean_model.clf"
-        with open('models/training_data.clf', 'rb') as file:
-            encodings = pickle.load(file)
-        encodings = np.array(encodings)
+        encodings = load_embeddings('models/training_data.emb').matrix
         mean_encoding = encodings.mean(axis=0)
         if model_save_path is not None:
             with open(model_save_path, 'wb') as file:
@@ -201,21 +310,10 @@ class EuclideanSorter(object):
         if model_encoding is None and model_path is None:
             raise Exception("Must supply svm classifier either through svm_clf or model_path")
         if model_encoding is None:
-            with open(model_path, 'rb') as f:
-                model_encoding = pickle.load(f)
-        image = cv2.imread(image_path)
-        locs = self.utils.get_face_locations(image=image,
-                                             model=self.face_model,
-                                             scaleup=self.upsample)
+            model_encoding = classifiers.load(model_path)
+        locs, faces_encodings = self.encode(image_path)
         if len(locs) == 0:
             return False
-        faces_encodings = list()
-        for (x, y, a, b) in locs:
-            face = image[y:b, x:a]
-            encode = self.utils.face_encodings(face,
-                                               model=self.encoding_model,
-                                               jitters=self.jitters)
-            faces_encodings.append(encode[0])
         results = self.utils.compare_faces(faces_encodings,
                                            model_encoding,
                                            tolerance=threshold)
@@ -224,6 +322,205 @@ class EuclideanSorter(object):
         else:
             return False
 
+    def match(self, image_path, threshold=1.2):
+        locs, faces_encodings = self.encode(image_path)
+        return self.match_encodings(faces_encodings, threshold=threshold)
+
+    def match_encodings(self, faces_encodings, threshold=1.2):
+        if len(faces_encodings) == 0:
+            return False
+        return bool(self.face_hits(faces_encodings, threshold).any())
+
+    def face_hits(self, matrix, threshold=1.2):
+        model_encoding = classifiers.load("models/predictor_euclidean_model.clf")
+        return self.utils.face_distance(np.asarray(matrix),
+                                        model_encoding) <= threshold
+
+    def classify_embeddings(self, matrix, owners, threshold=1.2):
+        if len(owners) == 0:
+            return dict()
+        hits = self.face_hits(matrix, threshold)
+        return dict((image, bool(best > 0)) for (image, best)
+                    in self.utils.group_max(owners, hits).items())
+
+    def get_image_list(self):
+        images_list = list()
+        try:
+            for path in os.listdir(self.folder):
+                if re.match('.*\.(jpg|png)', path.lower()):
+                    images_list.append(os.path.join(self.folder, path))
+        except:
+            print("Error - folder or file path is invalid")
+            sys.exit(0)
+        images_list.sort()
+        return images_list
+
+
+class GallerySorter(object):
+
+    def __init__(self):
+        self.utils = IU()
+        self.folder = None
+        self.face_model = 'hog'
+        self.encoding_model = '128D'
+        self.jitters = 3
+        self.upsample = 1
+        self.model_path = "models/predictor_gallery_model.clf"
+        # The index's vectors are kept out of the pickle and memory-mapped
+        self.vectors_path = "models/predictor_gallery_vectors.emb"
+        # 'brute', 'ivf', or 'auto' to pick by gallery size. brute checks
+        # every vector; with ivf a face is only compared with the people
+        # among its neighbours nearest vectors
+        self.index = 'auto'
+        self.neighbours = 16
+        # float16 and int8 galleries take 2x and 4x less memory than float32
+        self.precision = 'float32'
+
+    def set_folder(self, folder):
+        self.folder = folder
+
+    def set_params(self, model, encoding, jitters, upsample):
+        self.face_model = model
+        self.encoding_model = encoding
+        self.jitters = jitters
+        self.upsample = upsample
+
+    def warm_up(self):
+        self.utils.warm_up(model=self.encoding_model)
+
+    def set_cache(self, cache):
+        self.utils.cache = cache
+
+    def set_frames(self, frames):
+        self.utils.frames = frames
+
+    def set_detection(self, pixels, second_pass=True):
+        self.utils.detection_pixels = pixels
+        self.utils.second_pass = second_pass
+
+    def encode(self, image_path):
+        return self.utils.image_encodings([image_path],
+                                          face_model=self.face_model,
+                                          scaleup=self.upsample,
+                                          encoding_model=self.encoding_model,
+                                          jitters=self.jitters)[image_path]
+
+    def set_index(self, kind):
+        self.index = kind
+
+    def set_precision(self, precision):
+        self.precision = precision
+
+    def people(self):
+        return self.utils.list_people()
+
+    def stale(self):
+        # True if a training set changed since the gallery was built, or
+        # it was built with another kind of index or precision
+        if not os.path.isfile(self.model_path):
+            return True
+        built = os.stat(self.model_path).st_mtime_ns
+        for name in self.people():
+            path = find_embeddings(self.utils.people_path(name))
+            if os.stat(path).st_mtime_ns > built:
+                return True
+        gallery = classifiers.load(self.model_path)
+        index = gallery.get('index')
+        if index is None:
+            # Built before the gallery had an index
+            return True
+        if 'vectors' in gallery and not os.path.isfile(gallery['vectors']):
+            return True
+        if self.index != 'auto' and index.kind != self.index:
+            return True
+        return index.precision != self.precision
+
+    def train(self):
+        # Stacks everyone's training set into one indexed matrix; labels
+        # gives the person of each row
+        names = list()
+        encodings = list()
+        labels = list()
+        for name in self.people():
+            data = load_embeddings(self.utils.people_path(name)).matrix
+            if len(data) == 0:
+                continue
+            labels.append(np.full(len(data), len(names)))
+            names.append(name)
+            encodings.append(data)
+        if len(names) == 0:
+            raise Exception("No training sets found in {}".format(PEOPLE_DIR))
+        encodings = np.vstack(encodings)
+        index = make_index(self.index, size=len(encodings),
+                           precision=self.precision).fit(encodings)
+        save_embeddings(self.vectors_path, index.vectors,
+                        encoder=self.encoding_model, detector=None,
+                        dtype=index.vectors.dtype.name)
+        gallery = {'names': names,
+                   'labels': np.concatenate(labels),
+                   'index': index,
+                   'vectors': self.vectors_path}
+        vectors = index.vectors
+        index.vectors = None
+        try:
+            with open(self.model_path, 'wb') as file:
+                pickle.dump(gallery, file)
+        finally:
+            index.vectors = vectors
+        return gallery
+
+    def face_hits(self, matrix, threshold=1.0, gallery=None):
+        # (faces, people) matrix of whether each face is within threshold
+        # of one of that person's training encodings
+        if gallery is None:
+            gallery = self.load_gallery()
+        index = gallery['index']
+        hits = np.zeros((len(matrix), len(gallery['names'])), dtype=bool)
+        if index.kind == 'brute':
+            (faces, rows) = index.within(matrix, threshold)
+        else:
+            (distances, rows) = index.search(matrix, self.neighbours)
+            (faces, columns) = np.nonzero((rows >= 0) &
+                                          (distances <= threshold))
+            rows = rows[faces, columns]
+        hits[faces, gallery['labels'][rows]] = True
+        return hits
+
+    def load_gallery(self):
+        gallery = classifiers.load(self.model_path)
+        if 'index' not in gallery:
+            # Rebuilt by the caller (see stale()) rather than here, where
+            # every worker process would do it at once
+            raise Exception("The gallery was built by an older version; train it again")
+        index = gallery['index']
+        if index.vectors is None:
+            # Mapped once per loaded model; pages are shared between
+            # worker processes and only read as they are searched
+            index.vectors = load_embeddings(gallery['vectors']).matrix
+        return gallery
+
+    def classify_embeddings(self, matrix, owners, threshold=1.0):
+        # Returns {image: [names of everyone in it]} for each image in owners
+        if len(owners) == 0:
+            return dict()
+        gallery = self.load_gallery()
+        hits = self.face_hits(matrix, threshold, gallery)
+        names = gallery['names']
+        return dict((image, [names[i] for i in np.flatnonzero(best > 0)])
+                    for (image, best)
+                    in self.utils.group_max(owners, hits).items())
+
+    def match(self, image_path, threshold=1.0):
+        locs, faces_encodings = self.encode(image_path)
+        return self.match_encodings(faces_encodings, threshold=threshold)
+
+    def match_encodings(self, faces_encodings, threshold=1.0):
+        if len(faces_encodings) == 0:
+            return list()
+        owners = [('', i) for i in range(len(faces_encodings))]
+        return self.classify_embeddings(faces_encodings, owners,
+                                        threshold=threshold)['']
+
     def get_image_list(self):
         images_list = list()
         try:
@@ -0,0 +1,113 @@
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from gallery_index import BruteForceIndex
+from gallery_benchmark import synthetic_people
+from quantization import quantize, dequantize, nbytes, squared_distances
+from sort_cli import CLASSIFIERS
+
+
+def float64_distances(queries, vectors):
+    queries = np.asarray(queries, dtype=np.float64)
+    vectors = np.asarray(vectors, dtype=np.float64)
+    squared = (np.einsum('ij,ij->i', queries, queries)[:, None]
+               + np.einsum('ij,ij->i', vectors, vectors)[None, :]
+               - 2*np.dot(queries, vectors.T))
+    return np.sqrt(np.maximum(squared, 0))
+
+
+def decisions(distances, labels, compare_threshold, knn_threshold):
+    # compare_faces: every (query, gallery) pair within the tolerance.
+    # KNN: the person of the nearest vector, or -1 if it is too far
+    nearest = np.argmin(distances, axis=1)
+    closest = distances[np.arange(len(distances)), nearest]
+    people = np.where(closest <= knn_threshold, labels[nearest], -1)
+    return distances <= compare_threshold, people, nearest
+
+
+def agreement(reference, distances, labels, args):
+    (pairs, people, nearest) = decisions(distances, labels,
+                                         args.compare_threshold,
+                                         args.knn_threshold)
+    (pairs64, people64, nearest64) = reference
+    return {'compare_agreement': round(float(np.mean(pairs == pairs64)), 6),
+            'compare_flips': int(np.sum(pairs != pairs64)),
+            'knn_agreement': round(float(np.mean(people == people64)), 6),
+            'nearest_agreement': round(float(np.mean(nearest == nearest64)), 6)}
+
+
+def load_gallery(args):
+    # Returns (gallery, the person of each row, queries)
+    if args.embeddings:
+        from embedding_store import load_embeddings
+        vectors = np.asarray(load_embeddings(args.embeddings).matrix,
+                             dtype=np.float64)
+        # A real training set has no people labels; hold out some rows
+        state = np.random.RandomState(19)
+        order = state.permutation(len(vectors))
+        held = order[:min(args.queries, len(vectors)//2)]
+        kept = order[len(held):]
+        return (vectors[kept], np.zeros(len(kept), dtype=np.int64),
+                vectors[held])
+    state = np.random.RandomState(19)
+    (vectors, labels) = synthetic_people(args.size + args.queries, args.dim,
+                                         args.people)
+    # Jitter so the float64 values are not exactly float32 ones
+    vectors = vectors + 1e-4*state.randn(*vectors.shape)
+    return (vectors[:args.size], labels[:args.size], vectors[args.size:])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Memory and match agreement of quantised embeddings against float64')
+    parser.add_argument('--embeddings', default=None,
+                        help='a training set (.emb) to use instead of a synthetic gallery')
+    parser.add_argument('--size', type=int, default=20000)
+    parser.add_argument('--dim', type=int, default=128)
+    parser.add_argument('--people', type=int, default=500)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--compare-threshold', type=float,
+                        default=CLASSIFIERS['euclidean'][2],
+                        help='compare_faces tolerance')
+    parser.add_argument('--knn-threshold', type=float,
+                        default=CLASSIFIERS['knn'][2],
+                        help='largest distance of a KNN match')
+    args = parser.parse_args(argv)
+    (gallery, labels, queries) = load_gallery(args)
+    baseline = gallery.nbytes
+    reference = decisions(float64_distances(queries, gallery), labels,
+                          args.compare_threshold, args.knn_threshold)
+    # Galleries: stored quantised, distances computed from the codes
+    for precision in ('float32', 'float16', 'int8'):
+        index = BruteForceIndex(precision=precision).fit(gallery)
+        start = time.time()
+        distances = np.sqrt(np.maximum(squared_distances(queries,
+                                                         index.vectors,
+                                                         index.scale,
+                                                         index.norms), 0))
+        seconds = time.time() - start
+        result = {'store': 'gallery', 'precision': precision,
+                  'vectors': len(gallery), 'dim': gallery.shape[1],
+                  'bytes': index.nbytes(), 'float64_bytes': baseline,
+                  'memory_saved': round(1 - index.nbytes()/float(baseline), 4),
+                  'query_ms': round(seconds*1000/len(queries), 4)}
+        result.update(agreement(reference, distances, labels, args))
+        sys.stdout.write(json.dumps(result) + '\n')
+    # Caches: queries are stored quantised (int8 scaled per face) and
+    # widened back to float64 before they are classified
+    for precision in ('float32', 'float16', 'int8'):
+        (codes, scale) = quantize(queries, precision, axis=1)
+        restored = dequantize(codes, scale, np.float64)
+        result = {'store': 'cache', 'precision': precision,
+                  'faces': len(queries), 'dim': queries.shape[1],
+                  'bytes': nbytes(codes, scale),
+                  'float64_bytes': queries.nbytes,
+                  'memory_saved': round(1 - nbytes(codes, scale)/float(queries.nbytes), 4)}
+        result.update(agreement(reference, float64_distances(restored, gallery),
+                                labels, args))
+        sys.stdout.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+from output_modes import OUTPUT_MODES
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CLASSIFIERS = {
+    'euclidean': ('EuclideanSorter', 'models/predictor_euclidean_model.clf',
+                  1.2),
+    'knn': ('KNNSorter', 'models/predictor_knn_model.clf', 1.0),
+    'svm': ('SVMSorter', 'models/predictor_svm_model.clf', 0.005),
+    'nn': ('NNSorter', 'models/predictor_NN_model.h5', 0.85),
+    'gallery': ('GallerySorter', 'models/predictor_gallery_model.clf', 1.0),
+}
+
+
+def emit(event, **fields):
+    fields['event'] = event
+    sys.stdout.write(json.dumps(fields) + '\n')
+    sys.stdout.flush()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='batchsnap_sorter',
+                                     description='Sort photos using face recognition, without a GUI')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    sort = commands.add_parser('sort', help='sort a folder of images')
+    sort.add_argument('--input', required=True,
+                      help='folder containing the images to sort')
+    sort.add_argument('--output', required=True,
+                      help='folder the matching images are copied to')
+    sort.add_argument('--classifier', choices=sorted(CLASSIFIERS),
+                      default='euclidean')
+    sort.add_argument('--threshold', type=float, default=None,
+                      help='error threshold; defaults to the GUI default for the classifier')
+    sort.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                      help='number of worker processes')
+    sort.add_argument('--face-model', choices=['hog', 'cnn', 'cascade'],
+                      default='hog')
+    sort.add_argument('--encoding', choices=['128D', '512D'], default='128D')
+    sort.add_argument('--jitters', type=int, default=3)
+    sort.add_argument('--upsample', type=int, default=1)
+    sort.add_argument('--filter', default='',
+                      help='comma separated object classes an image must contain, e.g. person,dog')
+    sort.add_argument('--confidence', type=float, default=0.4,
+                      help='confidence level of object detection')
+    sort.add_argument('--filter-only', action='store_true',
+                      help='only apply the object filter, without face recognition')
+    sort.add_argument('--output-mode', choices=OUTPUT_MODES, default='copy',
+                      help='how matching images are written to the output folder')
+    sort.add_argument('--no-cache', action='store_true',
+                      help='do not use the on-disk embedding cache')
+    sort.add_argument('--cache-precision',
+                      choices=['float64', 'float32', 'float16', 'int8'],
+                      default='float64',
+                      help='precision new embeddings are cached with; float16 and int8 take 4x and 8x less space')
+    sort.add_argument('--no-journal', action='store_true',
+                      help='do not keep a journal to resume an interrupted sort from')
+    sort.add_argument('--watch', action='store_true',
+                      help='keep running and sort new or changed images as they arrive in the input folder')
+    sort.add_argument('--settle', type=float, default=2.0,
+                      help='seconds a new file must stay unchanged before it is sorted in watch mode')
+    sort.add_argument('--poll', action='store_true',
+                      help='in watch mode, poll the folder instead of using inotify')
+    sort.add_argument('--gallery-index', choices=['auto', 'brute', 'ivf'],
+                      default='auto',
+                      help='search index of the gallery classifier; ivf is approximate but fast for large galleries')
+    sort.add_argument('--gallery-precision', choices=['float32', 'float16', 'int8'],
+                      default='float32',
+                      help='precision the gallery classifier stores and compares embeddings in')
+    sort.add_argument('--detect-pixels', type=int, default=1920*1080,
+                      help='number of pixels images are scaled to for face detection')
+    sort.add_argument('--no-second-pass', action='store_true',
+                      help='do not retry face detection at a higher resolution when no face is found')
+    cluster = commands.add_parser('cluster', help='group the faces of a folder by person, without training data')
+    cluster.add_argument('--input', required=True,
+                         help='folder containing the images to cluster')
+    cluster.add_argument('--output', required=True,
+                         help='folder the clusters are written to')
+    cluster.add_argument('--threshold', type=float, default=None,
+                         help='largest distance between two faces of the same person; 0.5 for 128D, 1.0 for 512D by default')
+    cluster.add_argument('--neighbours', type=int, default=32,
+                         help='number of nearest faces each face is compared with')
+    cluster.add_argument('--min-size', type=int, default=2,
+                         help='smallest number of faces that makes a cluster')
+    cluster.add_argument('--face-model', choices=['hog', 'cnn', 'cascade'],
+                         default='hog')
+    cluster.add_argument('--encoding', choices=['128D', '512D'], default='128D')
+    cluster.add_argument('--jitters', type=int, default=3)
+    cluster.add_argument('--upsample', type=int, default=1)
+    cluster.add_argument('--output-mode', choices=OUTPUT_MODES, default='copy',
+                         help='how images are written to the cluster folders; manifest only writes clusters.tsv')
+    cluster.add_argument('--export-people', action='store_true',
+                         help='also save each cluster as a training set in models/people')
+    cluster.add_argument('--no-cache', action='store_true',
+                         help='do not use the on-disk embedding cache')
+    cluster.add_argument('--cache-precision',
+                         choices=['float64', 'float32', 'float16', 'int8'],
+                         default='float64',
+                         help='precision new embeddings are cached with')
+    return parser
+
+
+def list_images(folder):
+    # Unlike the sorters' get_image_list, which prints and exits, this
+    # raises OSError so the failure can be reported as an event
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                  if re.match('.*\\.(jpg|png)', name.lower()))
+
+
+def check_training_data(classifier, encoding):
+    from embedding_store import has_embeddings, encoder_mismatch
+    if classifier == 'nn':
+        data_path = 'models/training_data_positive.emb'
+    elif classifier == 'gallery':
+        people = list()
+        if os.path.isdir('models/people'):
+            people = sorted(path for path in os.listdir('models/people')
+                            if path.endswith(('.emb', '.clf')))
+        if len(people) == 0:
+            return 'You need to generate a training set for each person first'
+        data_path = os.path.join('models/people', people[0])
+    else:
+        data_path = 'models/training_data.emb'
+    if not has_embeddings(data_path):
+        return 'You need to generate training data first'
+    return encoder_mismatch(data_path, encoding)
+
+
+def journal_params(args, folder, model_path, threshold):
+    # Everything that changes which images match; a journal from a run
+    # with other settings is not resumed
+    model = None
+    if os.path.isfile(model_path):
+        stat = os.stat(model_path)
+        model = [os.path.abspath(model_path), stat.st_mtime_ns, stat.st_size]
+    return {'folder': folder, 'classifier': args.classifier, 'model': model,
+            'threshold': threshold, 'face_model': args.face_model,
+            'encoding_model': args.encoding, 'jitters': args.jitters,
+            'upsample': args.upsample,
+            'classes': sorted(c.strip() for c in args.filter.split(',')
+                              if c.strip()),
+            'confidence': args.confidence, 'filter_only': args.filter_only,
+            'output_mode': args.output_mode,
+            'detect_pixels': args.detect_pixels,
+            'second_pass': not args.no_second_pass,
+            'gallery_precision': args.gallery_precision,
+            'cache_precision': None if args.no_cache else args.cache_precision}
+
+
+def sort(args):
+    folder = os.path.abspath(args.input)
+    sort_path = os.path.abspath(args.output)
+    if not os.path.isdir(folder):
+        emit('error', message='Input folder does not exist: {}'.format(folder))
+        return 1
+    try:
+        image_list = list_images(folder)
+    except OSError as e:
+        emit('error', message='Cannot list the input folder: {}'.format(e))
+        return 1
+    (name, model_path, threshold) = CLASSIFIERS[args.classifier]
+    if args.threshold is not None:
+        threshold = args.threshold
+    # The models/ paths are relative to the app, as they are for the GUI;
+    # the nn classifier lives in its own copy of the app
+    app_dir = APP_DIR
+    if args.classifier == 'nn':
+        app_dir = os.path.join(APP_DIR, 'nn')
+    os.chdir(app_dir)
+    sys.path.insert(0, app_dir)
+    if not args.filter_only:
+        # The gallery is rebuilt from the people's training sets as needed
+        if args.classifier != 'gallery' and not os.path.isfile(model_path):
+            emit('error', message='The {} classifier has not been trained'.format(args.classifier))
+            return 1
+        message = check_training_data(args.classifier, args.encoding)
+        if message is not None:
+            emit('error', message=message)
+            return 1
+
+    if args.classifier == 'nn':
+        import neural_net as sorters
+    else:
+        import processing as sorters
+    from embedding_cache import EmbeddingCache
+    from engine import SortEngine
+    from pipeline import SortPipeline
+    from journal import RunJournal, JOURNAL_NAME
+
+    identifier = getattr(sorters, name)()
+    identifier.set_params(args.face_model, args.encoding, args.jitters,
+                          args.upsample)
+    identifier.set_detection(args.detect_pixels,
+                             second_pass=not args.no_second_pass)
+    identifier.set_folder(folder)
+    if args.classifier == 'gallery' and not args.filter_only:
+        identifier.set_index(args.gallery_index)
+        identifier.set_precision(args.gallery_precision)
+        if identifier.stale():
+            identifier.train()
+    cache = None
+    if not args.no_cache:
+        cache = EmbeddingCache(precision=args.cache_precision)
+        identifier.set_cache(cache)
+    classes = set(c.strip() for c in args.filter.split(',') if c.strip())
+    engine = None
+    if args.workers > 1:
+        engine = SortEngine(identifier, workers=args.workers)
+    journal = None
+    if not args.no_journal:
+        journal = RunJournal(os.path.join(sort_path, JOURNAL_NAME),
+                             journal_params(args, folder, model_path,
+                                            threshold)).open()
+    pipeline = SortPipeline(identifier, sort_path, threshold,
+                            classes=classes or None,
+                            conf=args.confidence,
+                            sort_state=not args.filter_only,
+                            engine=engine,
+                            output_mode=args.output_mode,
+                            journal=journal)
+    emit('start', input=folder, output=sort_path,
+         classifier=args.classifier, images=len(image_list),
+         output_mode=args.output_mode,
+         workers=args.workers,
+         resumed=len(journal.done) if journal is not None else 0)
+    start = time.time()
+    on_result = lambda image, matched: emit('result', image=image,
+                                            matched=matched,
+                                            seconds=round(time.time() - start, 3))
+    try:
+        if args.watch:
+            counts = watch_folder(args, pipeline, folder, on_result)
+        else:
+            counts = count_results(new_counts(),
+                                   pipeline.run(image_list,
+                                                on_result=on_result))
+            # Finished, so there is nothing left to resume
+            if journal is not None:
+                journal.finish()
+    finally:
+        if journal is not None:
+            journal.close()
+        if engine is not None:
+            engine.close()
+        if cache is not None:
+            cache.close()
+    elapsed = time.time() - start
+    if counts['people']:
+        emit('people', matched=counts['people'])
+    emit('summary', images=counts['images'], matched=counts['matched'],
+         seconds=round(elapsed, 3),
+         images_per_second=round(counts['images']/max(elapsed, 1e-6), 3))
+    return 0
+
+
+def watch_folder(args, pipeline, folder, on_result):
+    # Runs until interrupted; the sorter, engine and pipeline stay warm
+    # between batches
+    from watcher import FolderWatcher, watch
+    watcher = FolderWatcher(folder, settle=args.settle,
+                            use_inotify=not args.poll)
+    emit('watching', input=folder,
+         method='inotify' if watcher.inotify is not None else 'polling')
+    # Only counts are kept, so a long running watch does not grow
+    counts = new_counts()
+    on_error = lambda paths, e: emit('error', message=str(e),
+                                     images=len(paths))
+    try:
+        watch(pipeline, watcher, on_result=on_result,
+              on_batch=lambda results: count_results(counts, results),
+              on_error=on_error)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return counts
+
+
+def new_counts():
+    return {'images': 0, 'matched': 0, 'people': dict()}
+
+
+def count_results(counts, results):
+    for (image, matched) in results:
+        counts['images'] += 1
+        if matched:
+            counts['matched'] += 1
+        if isinstance(matched, list):
+            for name in matched:
+                counts['people'][name] = counts['people'].get(name, 0) + 1
+    return counts
+
+
+def cluster(args):
+    folder = os.path.abspath(args.input)
+    sort_path = os.path.abspath(args.output)
+    if not os.path.isdir(folder):
+        emit('error', message='Input folder does not exist: {}'.format(folder))
+        return 1
+    try:
+        image_list = list_images(folder)
+    except OSError as e:
+        emit('error', message='Cannot list the input folder: {}'.format(e))
+        return 1
+    os.chdir(APP_DIR)
+    sys.path.insert(0, APP_DIR)
+    from clustering import FaceClusterer
+    from embedding_cache import EmbeddingCache
+
+    clusterer = FaceClusterer(threshold=args.threshold,
+                              neighbours=args.neighbours,
+                              min_size=args.min_size)
+    clusterer.set_params(args.face_model, args.encoding, args.jitters,
+                         args.upsample)
+    clusterer.set_folder(folder)
+    cache = None
+    if not args.no_cache:
+        cache = EmbeddingCache(precision=args.cache_precision)
+        clusterer.set_cache(cache)
+    emit('start', input=folder, output=sort_path, images=len(image_list),
+         output_mode=args.output_mode)
+    start = time.time()
+    try:
+        (clusters, unclustered) = clusterer.cluster(image_list)
+        clusterer.write(clusters, sort_path, mode=args.output_mode)
+        if args.export_people:
+            for path in clusterer.export_people(clusters):
+                emit('exported', path=os.path.join(APP_DIR, path))
+    finally:
+        if cache is not None:
+            cache.close()
+    for (i, faces) in enumerate(clusters):
+        emit('cluster', name=clusterer.cluster_name(i), faces=len(faces),
+             images=len(set(face[0] for face in faces)))
+    elapsed = time.time() - start
+    emit('summary', images=len(image_list), clusters=len(clusters),
+         clustered_faces=sum(len(faces) for faces in clusters),
+         unclustered_faces=len(unclustered),
+         seconds=round(elapsed, 3))
+    return 0
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        if args.command == 'sort':
+            return sort(args)
+        if args.command == 'cluster':
+            return cluster(args)
+    except Exception as e:
+        emit('error', message=str(e), type=type(e).__name__)
+        return 1
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,36 +3,387 @@ import numpy as np
 import dlib
 from shutil import rmtree
 import os
-import pickle
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import tensorflow as tf
 from PIL import Image
 from facenet import facenet
+from embedding_store import save_embeddings
 import face_recognition_models as FRM
 import face_recognition as FR
 
 
+class FaceNetEncoder(object):
+
+    def __init__(self, model_path='models/20180402-114759.pb'):
+        self.model_path = model_path
+        self.graph = None
+        self.session = None
+        self.img_holder = None
+        self.embeddings = None
+        self.phase_train = None
+
+    def load(self):
+        if self.session is not None:
+            return
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            facenet.load_model(self.model_path)
+            self.img_holder = self.graph.get_tensor_by_name('input:0')
+            self.embeddings = self.graph.get_tensor_by_name('embeddings:0')
+            self.phase_train = self.graph.get_tensor_by_name('phase_train:0')
+        self.session = tf.Session(graph=self.graph)
+
+    def warm_up(self):
+        # The first session.run allocates buffers and picks kernels,
+        # so pay for it before the sort loop starts
+        self.load()
+        self.encode(np.zeros((1, 160, 160, 3), dtype=np.float32))
+
+    def encode(self, images):
+        self.load()
+        feed_dict = {self.img_holder: images, self.phase_train: False}
+        return self.session.run(self.embeddings, feed_dict=feed_dict)
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+        self.graph = None
+        self.session = None
+        self.img_holder = None
+        self.embeddings = None
+        self.phase_train = None
+
+
+_facenet_encoder = None
+
+
+def get_facenet_encoder():
+    global _facenet_encoder
+    if _facenet_encoder is None:
+        _facenet_encoder = FaceNetEncoder()
+    return _facenet_encoder
+
+
+def close_facenet_encoder():
+    global _facenet_encoder
+    if _facenet_encoder is not None:
+        _facenet_encoder.close()
+        _facenet_encoder = None
+
+
+_shape_predictor = None
+
+
+def get_shape_predictor():
+    global _shape_predictor
+    if _shape_predictor is None:
+        model = FRM.pose_predictor_five_point_model_location()
+        _shape_predictor = dlib.shape_predictor(model)
+    return _shape_predictor
+
+
+# MobileNet-SSD nets are not safe to share between threads, so each thread
+# loads its own once and keeps it for the life of the process
+_object_nets = threading.local()
+
+OBJECT_CLASSES = ["background", "aeroplane", "bicycle", "bird", "boat",
+                  "bottle", "bus", "car", "cat", "chair", "cow", "diningtable",
+                  "dog", "horse", "motorbike", "person", "pottedplant", "sheep",
+                  "sofa", "train", "tvmonitor"]
+
+
+def get_object_detector():
+    net = getattr(_object_nets, 'net', None)
+    if net is None:
+        net = cv2.dnn.readNetFromCaffe('models/MNSSD_deploy.prototxt.txt',
+                                       'models/MNSSD_detector.caffemodel')
+        _object_nets.net = net
+    return net
+
+
+# Training sets of named people, one embedding file each
+PEOPLE_DIR = 'models/people'
+
+
+def valid_name(name):
+    # A person's name becomes a file and a folder name, so it must not
+    # reach outside the folder it is put in
+    return (bool(name) and os.path.basename(name) == name and
+            '\\' not in name and not name.startswith('.'))
+
+# JPEGs are decoded straight at 1/2, 1/4 or 1/8 size by scaling in the
+# DCT domain, which is much cheaper than a full decode and a resize
+READ_FLAGS = {1: cv2.IMREAD_COLOR,
+              2: cv2.IMREAD_REDUCED_COLOR_2,
+              4: cv2.IMREAD_REDUCED_COLOR_4,
+              8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+class FrameCache(object):
+
+    def __init__(self, max_bytes=256*1024*1024):
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, image_path, reduction=1):
+        # Frames are shared between consumers, so treat them as read-only
+        key = (os.path.abspath(image_path), reduction)
+        with self.lock:
+            frame = self.frames.get(key)
+            if frame is not None:
+                self.frames.move_to_end(key)
+                return frame
+        frame = cv2.imread(image_path, READ_FLAGS[reduction])
+        if frame is None:
+            return None
+        with self.lock:
+            if key not in self.frames:
+                self.frames[key] = frame
+                self.size += frame.nbytes
+            while self.size > self.max_bytes and len(self.frames) > 1:
+                (old, evicted) = self.frames.popitem(last=False)
+                self.size -= evicted.nbytes
+        return frame
+
+    def discard(self, image_path):
+        path = os.path.abspath(image_path)
+        with self.lock:
+            for reduction in READ_FLAGS:
+                frame = self.frames.pop((path, reduction), None)
+                if frame is not None:
+                    self.size -= frame.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.size = 0
+
+
 class ImageUtilities(object):
 
-    def __init__(self):
-        pass
+    def __init__(self, encoder=None, cache=None, frames=None):
+        self.encoder = encoder
+        self.cache = cache
+        self.frames = frames
+        # Working resolution for face detection, and whether to look again
+        # at a higher resolution when nothing is found
+        self.detection_pixels = 1920*1080
+        self.second_pass = True
+        # The cascade face model runs HOG first and only runs the CNN on
+        # images where HOG found nothing or a box scored below this
+        self.cascade_threshold = 0.5
+        self.cnn_batch_size = 8
 
-    def get_face_locations(self, image, model='hog', scaleup=1):
-        locs = list()
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    def get_encoder(self):
+        if self.encoder is None:
+            self.encoder = get_facenet_encoder()
+        return self.encoder
+
+    def warm_up(self, model='128D'):
+        if model == '512D':
+            self.get_encoder().warm_up()
+
+    def load_image(self, image_path, reduction=1):
+        if self.frames is not None:
+            return self.frames.get(image_path, reduction=reduction)
+        return cv2.imread(image_path, READ_FLAGS[reduction])
+
+    def reduction_for(self, scale):
+        # Largest decode reduction that still leaves at least `scale` of
+        # the full resolution
+        for reduction in (8, 4, 2):
+            if 1.0/reduction >= scale:
+                return reduction
+        return 1
+
+    def image_size(self, image_path, image):
+        # Full resolution (w, h) of a file decoded at reduced size, read
+        # from the header and oriented like the decoded frame
+        with Image.open(image_path) as header:
+            (w, h) = header.size
+        if (w > h) != (image.shape[1] > image.shape[0]):
+            (w, h) = (h, w)
+        return (w, h)
+
+    def detection_scale(self, size):
+        (w, h) = size
+        return min(1.0, math.sqrt(float(self.detection_pixels)/(w*h)))
+
+    def detector_key(self, face_model):
+        # Cached face locations depend on the detection settings too
+        key = '{}/{}px'.format(face_model, self.detection_pixels)
+        if self.second_pass:
+            key += '/2pass'
+        if face_model == 'cascade':
+            key += '/{}'.format(self.cascade_threshold)
+        return key
+
+    def load_detection_image(self, image_path, scale=None):
+        # Returns the frame and, if it was decoded at reduced size, the
+        # full resolution size that face locations are reported in
+        if scale is None:
+            try:
+                with Image.open(image_path) as header:
+                    scale = self.detection_scale(header.size)
+            except IOError:
+                scale = 1.0
+        reduction = self.reduction_for(scale)
+        image = self.load_image(image_path, reduction=reduction)
+        if image is None or reduction == 1:
+            return image, None
+        return image, self.image_size(image_path, image)
+
+    def face_crops(self, image_path, locs, image=None, size=None,
+                   min_size=160):
+        # Crops faces from the smallest decode that keeps every face at
+        # least min_size pixels across, since encoders work on 160x160
+        # crops anyway; image/size can pass in a frame already decoded
+        if len(locs) == 0:
+            return list()
+        smallest = min(min(eX - sX, eY - sY) for (sX, sY, eX, eY) in locs)
+        reduction = 1
+        for r in (8, 4, 2):
+            if smallest/r >= min_size:
+                reduction = r
+                break
+        given = None
+        if image is not None:
+            given = 1
+            if size is not None:
+                given = int(round(float(size[0])/image.shape[1]))
+        if given == reduction:
+            source = image
+        else:
+            source = self.load_image(image_path, reduction=reduction)
+        (h, w) = source.shape[:2]
+        fx = fy = 1.0/reduction
+        if reduction > 1:
+            (full_w, full_h) = self.image_size(image_path, source)
+            fx = float(w)/full_w
+            fy = float(h)/full_h
+        # Copies, so the crops don't keep the whole frame alive
+        crops = list()
+        for (sX, sY, eX, eY) in locs:
+            crops.append(source[max(0, int(sY*fy)):int(eY*fy),
+                                max(0, int(sX*fx)):int(eX*fx)].copy())
+        return crops
+
+    def release_image(self, image_path):
+        if self.frames is not None:
+            self.frames.discard(image_path)
+
+    def get_face_locations(self, image, model='hog', scaleup=1, size=None,
+                           scale=None):
+        # size is the full resolution (w, h) when image was decoded at a
+        # reduced size; locations are always in full resolution pixels.
+        # By default the image is scaled to detection_pixels
+        return self.batch_face_locations([image], model=model,
+                                         scaleup=scaleup, sizes=[size],
+                                         scale=scale)[0]
+
+    def batch_face_locations(self, images, model='hog', scaleup=1,
+                             sizes=None, scale=None):
+        # get_face_locations for many images, so the CNN detector can run
+        # on batches of frames
+        if sizes is None:
+            sizes = [None]*len(images)
+        frames = list()
+        for (image, size) in zip(images, sizes):
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            (h, w) = image.shape[:2]
+            if size is not None:
+                (w, h) = size
+            factor = scale
+            if factor is None:
+                factor = self.detection_scale((w, h))
+            target = (max(1, int(w*factor)), max(1, int(h*factor)))
+            if target != (image.shape[1], image.shape[0]):
+                image = cv2.resize(image, target)
+            frames.append((image, factor))
+        if model == 'cnn':
+            faces = self.cnn_locations([image for (image, factor) in frames],
+                                       scaleup)
+        elif model == 'cascade':
+            faces = list()
+            escalate = list()
+            for i, (image, factor) in enumerate(frames):
+                found = self.hog_locations(image, scaleup)
+                if found is None:
+                    escalate.append(i)
+                faces.append(found)
+            found = self.cnn_locations([frames[i][0] for i in escalate],
+                                       scaleup)
+            for (i, locs) in zip(escalate, found):
+                faces[i] = locs
+        else:
+            faces = [FR.face_locations(image,
+                                       number_of_times_to_upsample=scaleup,
+                                       model=model)
+                     for (image, factor) in frames]
+        results = list()
+        for (found, (image, factor)) in zip(faces, frames):
+            locs = list()
+            for (t, r, b, l) in found:
+                sX = int(l/factor); sY = int(t/factor);
+                eX = int(r/factor); eY = int(b/factor);
+                locs.append((sX, sY, eX, eY))
+            results.append(locs)
+
+        return results
+
+    def hog_locations(self, image, scaleup=1):
+        # Returns None when the CNN should take another look
+        (rects, scores, kinds) = FR.api.face_detector.run(image, scaleup, 0)
+        if len(rects) == 0 or min(scores) < self.cascade_threshold:
+            return None
         (h, w) = image.shape[:2]
-        image = cv2.resize(image, (int(w*0.4), int(h*0.4)))
-        faces = FR.face_locations(image,
-                                  number_of_times_to_upsample=scaleup,
-                                  model=model)
-        for (t, r, b, l) in faces:
-            sX = int(l*2.5); sY = int(t*2.5);
-            eX = int(r*2.5); eY = int(b*2.5);
-            locs.append((sX, sY, eX, eY))
+        return [(max(rect.top(), 0), min(rect.right(), w),
+                 min(rect.bottom(), h), max(rect.left(), 0))
+                for rect in rects]
+
+    def cnn_locations(self, images, scaleup=1):
+        # The CNN only batches images of the same size
+        faces = [None]*len(images)
+        groups = dict()
+        for i, image in enumerate(images):
+            groups.setdefault(image.shape, list()).append(i)
+        for indexes in groups.values():
+            for start in range(0, len(indexes), self.cnn_batch_size):
+                chunk = indexes[start:start+self.cnn_batch_size]
+                found = FR.batch_face_locations([images[i] for i in chunk],
+                                                number_of_times_to_upsample=scaleup,
+                                                batch_size=len(chunk))
+                for (i, locs) in zip(chunk, found):
+                    faces[i] = locs
+        return faces
 
-        return locs
+    def people_path(self, name):
+        if not valid_name(name):
+            raise Exception("Invalid name: {}".format(name))
+        return os.path.join(PEOPLE_DIR, name + '.emb')
+
+    def list_people(self):
+        # Names of everyone with a training set of their own
+        if not os.path.isdir(PEOPLE_DIR):
+            return list()
+        # .clf is the pickled format of older versions
+        return sorted(set(os.path.splitext(path)[0]
+                          for path in os.listdir(PEOPLE_DIR)
+                          if path.endswith(('.emb', '.clf')) and
+                          valid_name(os.path.splitext(path)[0])))
 
     def generate_training_set(self, encoder='128D', jitters=3,
-                              face_model='hog', scaleup=1):
+                              face_model='hog', scaleup=1, name=None):
+        save_path = 'models/training_data.emb'
+        if name:
+            save_path = self.people_path(name)
+            if not os.path.isdir(PEOPLE_DIR):
+                os.makedirs(PEOPLE_DIR)
         video_capture = cv2.VideoCapture(0)
         count = 0
         encodings = list()
@@ -67,48 +418,78 @@ class ImageUtilities(object):
                     encodings.append(encoding[0])
                     count += 1
             elif key == ord('q') and count > 30:
-                with open('models/training_data.clf', 'wb') as file:
-                    pickle.dump(encodings, file)
+                save_embeddings(save_path, encodings, encoder=encoder,
+                                detector=face_model)
                 break
             # Debug
             elif key == ord('d'):
-                with open('models/training_data.clf', 'wb') as file:
-                    pickle.dump(encodings, file)
+                save_embeddings(save_path, encodings, encoder=encoder,
+                                detector=face_model)
                 break
         video_capture.release()
         cv2.destroyAllWindows()
 
-    def detect_objects(self, image_list, conf=0.4, bar=None, classes=None):
-        net = cv2.dnn.readNetFromCaffe('models/MNSSD_deploy.prototxt.txt',
-                                       'models/MNSSD_detector.caffemodel')
-        CLASSES = ["background", "aeroplane", "bicycle", "bird", "boat",
-	"bottle", "bus", "car", "cat", "chair", "cow", "diningtable",
-	"dog", "horse", "motorbike", "person", "pottedplant", "sheep",
-	"sofa", "train", "tvmonitor"]
+    def object_detector(self):
+        return get_object_detector()
+
+    def has_objects(self, image, net=None, conf=0.4, classes=None):
+        return self.has_objects_batch([image], net=net, conf=conf,
+                                      classes=classes)[0]
+
+    def has_objects_batch(self, images, net=None, conf=0.4, classes=None):
+        # One forward pass for the whole batch; each detection row starts
+        # with the index of the image it belongs to
+        if net is None:
+            net = self.object_detector()
+        found = [False]*len(images)
+        if len(images) == 0:
+            return found
+        blob = cv2.dnn.blobFromImages([cv2.resize(image, (300, 300))
+                                       for image in images],
+                                      0.007843,
+                                      (300, 300),
+                                      127.5)
+        net.setInput(blob)
+        detections = net.forward().reshape(-1, 7)
+        for detection in detections[detections[:, 2] > conf]:
+            idx = int(detection[1])
+            if OBJECT_CLASSES[idx] in classes:
+                found[int(detection[0])] = True
+        return found
+
+    def filter_chunk(self, image_paths, conf=0.4, classes=None):
+        images = list()
+        paths = list()
+        for image_path in image_paths:
+            (image, size) = self.load_detection_image(image_path)
+            if image is not None:
+                images.append(image)
+                paths.append(image_path)
+        found = self.has_objects_batch(images, conf=conf, classes=classes)
+        for image_path in paths:
+            self.release_image(image_path)
+        return [image_path for (image_path, ok) in zip(paths, found) if ok]
+
+    def detect_objects(self, image_list, conf=0.4, bar=None, classes=None,
+                       batch_size=16, threads=1):
+        # Images are filtered in chunks of batch_size, on up to threads
+        # threads with a net of their own
         results = list()
+        if len(image_list) == 0:
+            return results
         done = 0
-        increment = float(100.00/len(image_list))
+        increment = float(100.00*batch_size/len(image_list))
         if bar is not None:
             bar.setValue(0)
-        for image_path in image_list:
-            image = cv2.imread(image_path)
-            (h, w) = image.shape[:2]
-            blob = cv2.dnn.blobFromImage(cv2.resize(image, (300, 300)),
-                                         0.007843,
-                                         (300, 300),
-                                         127.5)
-            net.setInput(blob)
-            detections = net.forward()
-            for i in range(0, detections.shape[2]):
-                confidence = detections[0, 0, i, 2]
-                if confidence > conf:
-                    idx = int(detections[0, 0, i, 1])
-                    if CLASSES[idx] in classes:
-                        results.append(image_path)
-                        break
-            if bar is not None:
-                done += increment
-                bar.setValue(done)
+        chunks = [image_list[start:start+batch_size]
+                  for start in range(0, len(image_list), batch_size)]
+        with ThreadPoolExecutor(max(1, threads)) as pool:
+            for matched in pool.map(lambda chunk: self.filter_chunk(
+                    chunk, conf=conf, classes=classes), chunks):
+                results.extend(matched)
+                if bar is not None:
+                    done += increment
+                    bar.setValue(min(done, 100))
         if bar is not None:
             bar.setValue(100)
 
@@ -119,27 +500,243 @@ class ImageUtilities(object):
         image = cv2.resize(image, (160, 160))
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         if align is True:
-            image = self.align_face(image)
+            shape = self.face_landmarks(image)
+            if model != '512D':
+                # dlib aligns to its own chip from the same landmarks
+                encoding = FR.api.face_encoder.compute_face_descriptor(
+                    image, shape, jitters)
+                return [np.array(encoding)]
+            image = self.align_faces([image], [shape])[0]
         if model == '512D':
             if prewhiten is True:
                 image = self.prewhiten(image)
-            with tf.Graph().as_default():
-                with tf.Session() as session:
-                    facenet.load_model('models/20180402-114759.pb')
-                    img_holder = tf.get_default_graph().get_tensor_by_name(
-                        'input:0')
-                    embeddings = tf.get_default_graph().get_tensor_by_name(
-                        'embeddings:0')
-                    phase_train = tf.get_default_graph().get_tensor_by_name(
-                        'phase_train:0')
-                    feed_dict = {img_holder:[image], phase_train:False}
-                    encoding = session.run(embeddings, feed_dict = feed_dict)
+            encoding = self.get_encoder().encode([image])
         else:
+            # image is already the face, so landmarks are found within the
+            # whole crop rather than by running the detector on it again
             encoding = FR.face_encodings(image,
+                                         known_face_locations=[(0, 160, 160, 0)],
                                          num_jitters=jitters)
 
         return encoding
 
+    def face_encodings_batch(self, crops, model='512D', batch_size=32,
+                             jitters=3, prewhiten=True, align=False):
+        # crops is a list of (image, face index, face crop) triples; the
+        # returned owners list maps each row of encodings back to them
+        owners = list()
+        if model != '512D':
+            encodings = list()
+            for (owner, index, crop) in crops:
+                encoding = self.face_encodings(crop, model=model,
+                                               jitters=jitters,
+                                               align=align)
+                if len(encoding) == 0:
+                    continue
+                encodings.append(encoding[0])
+                owners.append((owner, index))
+            if len(encodings) == 0:
+                return np.empty((0, self.encoding_size(model))), owners
+            return np.vstack(encodings), owners
+        encoder = self.get_encoder()
+        batches = list()
+        for start in range(0, len(crops), batch_size):
+            chunk = crops[start:start+batch_size]
+            faces = np.empty((len(chunk), 160, 160, 3), dtype=np.float32)
+            for i, (owner, index, crop) in enumerate(chunk):
+                face = cv2.resize(crop, (160, 160))
+                faces[i] = cv2.cvtColor(face, cv2.COLOR_BGR2RGB)
+                owners.append((owner, index))
+            if align is True:
+                faces = np.array(self.align_faces(faces.astype(np.uint8)),
+                                 dtype=np.float32)
+            if prewhiten is True:
+                faces = self.prewhiten_batch(faces)
+            batches.append(encoder.encode(faces))
+        if len(batches) == 0:
+            return np.empty((0, self.encoding_size(model))), owners
+        return np.vstack(batches), owners
+
+    def detect_faces(self, image_path, image=None, face_model='hog',
+                     scaleup=1, key=None, size=None):
+        frames = None
+        if image is not None:
+            frames = {image_path: (image, size)}
+        return self.detect_faces_batch([image_path], face_model=face_model,
+                                       scaleup=scaleup,
+                                       keys={image_path: key},
+                                       frames=frames)[image_path]
+
+    def detect_faces_batch(self, image_paths, face_model='hog', scaleup=1,
+                           keys=None, frames=None):
+        # Returns {image path: face locations}; frames can pass in
+        # {image path: (image, size)} already decoded
+        detector = self.detector_key(face_model)
+        keys = keys or dict()
+        frames = frames or dict()
+        results = dict()
+        pending = list()
+        for image_path in image_paths:
+            key = keys.get(image_path)
+            if self.cache is not None and key is not None:
+                locs = self.cache.get_locations(key, detector, scaleup)
+                if locs is not None:
+                    results[image_path] = locs
+                    continue
+            (image, size) = frames.get(image_path, (None, None))
+            if image is None:
+                (image, size) = self.load_detection_image(image_path)
+            if image is None:
+                results[image_path] = list()
+                continue
+            pending.append((image_path, image, size))
+        found = self.batch_face_locations([image for (p, image, s) in pending],
+                                          model=face_model,
+                                          scaleup=scaleup,
+                                          sizes=[s for (p, i, s) in pending])
+        for ((image_path, image, size), locs) in zip(pending, found):
+            if len(locs) == 0 and self.second_pass:
+                locs = self.second_pass_locations(image_path, image, size,
+                                                  face_model, scaleup)
+            key = keys.get(image_path)
+            if self.cache is not None and key is not None:
+                self.cache.put_locations(key, detector, scaleup, locs)
+            results[image_path] = locs
+        return results
+
+    def second_pass_locations(self, image_path, image, size, face_model,
+                              scaleup):
+        # Big images get another look at twice the resolution; images that
+        # were already detected at full size get one more upsample instead
+        if size is None:
+            size = (image.shape[1], image.shape[0])
+        scale = self.detection_scale(size)
+        if scale < 1.0:
+            scale = min(1.0, scale*2)
+        else:
+            scaleup += 1
+        (image, size) = self.load_detection_image(image_path, scale=scale)
+        if image is None:
+            return list()
+        return self.get_face_locations(image=image, model=face_model,
+                                       scaleup=scaleup, size=size,
+                                       scale=scale)
+
+    def image_encodings(self, image_paths, face_model='hog', scaleup=1,
+                        encoding_model='128D', jitters=3, batch_size=32):
+        # Returns {image path: (face locations, encodings)}, with one
+        # location per encoding row; faces that fail to encode are dropped
+        results = dict()
+        keys = dict()
+        crops = list()
+        for image_path in image_paths:
+            if image_path in results or image_path in keys:
+                continue
+            key = None
+            if self.cache is not None:
+                key = self.cache.file_key(image_path)
+                cached = self.cache.get_encodings(key,
+                                                  self.detector_key(face_model),
+                                                  scaleup,
+                                                  encoding_model, jitters)
+                if cached is not None:
+                    results[image_path] = cached
+                    continue
+            keys[image_path] = key
+        pending = list(keys)
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start+batch_size]
+            found = self.detect_faces_batch(chunk, face_model=face_model,
+                                            scaleup=scaleup, keys=keys)
+            for image_path in chunk:
+                locs = found[image_path]
+                for i, crop in enumerate(self.face_crops(image_path, locs)):
+                    crops.append((image_path, i, crop))
+                results[image_path] = (locs, None)
+        encodings, owners = self.face_encodings_batch(crops,
+                                                      model=encoding_model,
+                                                      batch_size=batch_size,
+                                                      jitters=jitters)
+        rows = dict((image_path, list()) for image_path in keys)
+        for row, (image_path, i) in enumerate(owners):
+            rows[image_path].append((i, row))
+        for image_path, key in keys.items():
+            self.release_image(image_path)
+            locs = results[image_path][0]
+            face_locs = [locs[i] for (i, row) in rows[image_path]]
+            face_encodings = encodings[[row for (i, row) in rows[image_path]]]
+            results[image_path] = (face_locs, face_encodings)
+            if self.cache is not None:
+                self.cache.put_encodings(key, self.detector_key(face_model),
+                                         scaleup,
+                                         encoding_model, jitters,
+                                         face_locs, face_encodings)
+
+        return results
+
+    def encode_images(self, image_paths, face_model='hog', scaleup=1,
+                      encoding_model='128D', jitters=3, batch_size=32):
+        # Returns a float32 (faces, dim) matrix and the (image, face index)
+        # of each row. Images are encoded batch_size at a time, so only one
+        # batch of crops and frames is held however big the folder is
+        owners = list()
+        encodings = list()
+        for start in range(0, len(image_paths), batch_size):
+            chunk = image_paths[start:start+batch_size]
+            results = self.image_encodings(chunk, face_model=face_model,
+                                           scaleup=scaleup,
+                                           encoding_model=encoding_model,
+                                           jitters=jitters,
+                                           batch_size=batch_size)
+            rows = list()
+            for image_path in chunk:
+                if image_path not in results:
+                    continue
+                face_encodings = results.pop(image_path)[1]
+                for i in range(len(face_encodings)):
+                    owners.append((image_path, i))
+                    rows.append(face_encodings[i])
+            del results
+            if len(rows) > 0:
+                encodings.append(np.asarray(rows, dtype=np.float32))
+        if len(owners) == 0:
+            return (np.empty((0, self.encoding_size(encoding_model)),
+                             dtype=np.float32), owners)
+
+        return np.vstack(encodings), owners
+
+    def group_max(self, owners, values):
+        # Reduces per-face values (or rows of values) to the best of each
+        # image; owners are (image, face index) pairs as from encode_images
+        if len(owners) == 0:
+            return dict()
+        images = [owner[0] for owner in owners]
+        (keys, index) = np.unique(images, return_inverse=True)
+        values = np.asarray(values, dtype=np.float64)
+        best = np.full((len(keys),) + values.shape[1:], -np.inf)
+        np.maximum.at(best, index, values)
+        first = dict()
+        for (image, i) in zip(images, index):
+            first.setdefault(i, image)
+        return dict((first[i], best[i]) for i in range(len(keys)))
+
+    def encoding_size(self, model='128D'):
+        if model == '512D':
+            return 512
+        return 128
+
+    def prewhiten_batch(self, x):
+        x = np.array(x, dtype=np.float32)
+        axes = tuple(range(1, x.ndim))
+        mean = np.mean(x, axis=axes, keepdims=True)
+        std = np.std(x, axis=axes, keepdims=True)
+        size = np.prod(x.shape[1:])
+        std_adj = np.maximum(std, np.float32(1.0/np.sqrt(size)))
+        x -= mean
+        x /= std_adj
+
+        return x
+
     def prewhiten(self, x):
         mean = np.mean(x)
         std = np.std(x)
@@ -148,17 +745,20 @@ class ImageUtilities(object):
         
         return y
 
-    def align_face(self, image):
-        faces = dlib.full_object_detections()
+    def face_landmarks(self, image):
         (h, w) = image.shape[:2]
-        loc = dlib.rectangle(h, w, 0, 0)
-        model = FRM.pose_predictor_five_point_model_location()
-        sp = dlib.shape_predictor(model)
-        faces.append(sp(image, loc))
-        aligned = dlib.get_face_chip(image, faces[0],
-                                     size=160)
+        return get_shape_predictor()(image, dlib.rectangle(0, 0, w, h))
 
-        return aligned
+    def align_faces(self, images, shapes=None):
+        # Aligns a batch of face crops; landmarks already found for them
+        # can be passed in as shapes
+        if shapes is None:
+            shapes = [self.face_landmarks(image) for image in images]
+        return [dlib.get_face_chip(image, shape, size=160)
+                for (image, shape) in zip(images, shapes)]
+
+    def align_face(self, image):
+        return self.align_faces([image])[0]
 
     def face_distance(self, face_encodings, face_to_compare):
         if len(face_encodings) == 0:
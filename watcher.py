@@ -0,0 +1,194 @@
+import os
+import re
+import time
+import errno
+import select
+import struct
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                        use_errno=True)
+    _libc.inotify_init1
+except (ImportError, OSError, AttributeError):
+    _libc = None
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+IN_Q_OVERFLOW = 0x00004000
+_EVENT = struct.Struct('iIII')
+
+IMAGE_PATTERN = '.*\\.(jpg|png)'
+
+
+class Inotify(object):
+    # Names of files created, written or moved into a folder, straight from
+    # the kernel; raises OSError where inotify is not available
+
+    def __init__(self, folder):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if _libc.inotify_add_watch(self.fd, os.fsencode(folder), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, 'inotify_add_watch failed')
+
+    def read(self, timeout):
+        # Returns the set of changed names, or None if events were lost
+        # and the folder should be rescanned
+        names = set()
+        ready = select.select([self.fd], [], [], timeout)[0]
+        while ready:
+            try:
+                data = os.read(self.fd, 64*1024)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            offset = 0
+            while offset < len(data):
+                (wd, mask, cookie, length) = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset+length].rstrip(b'\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if name:
+                    names.add(os.fsdecode(name))
+            ready = select.select([self.fd], [], [], 0)[0]
+        return names
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class FolderWatcher(object):
+    # Hands out images once they have stopped changing for settle seconds,
+    # and again whenever they change after being processed
+
+    def __init__(self, folder, settle=2.0, interval=1.0, pattern=IMAGE_PATTERN,
+                 use_inotify=True):
+        self.folder = folder
+        self.settle = settle
+        self.interval = interval
+        self.pattern = re.compile(pattern)
+        self.done = dict()
+        self.pending = dict()
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify(folder)
+            except OSError:
+                self.inotify = None
+        self.started = False
+
+    def signature(self, image_path):
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def scan(self):
+        return [name for name in os.listdir(self.folder)
+                if self.pattern.match(name.lower())]
+
+    def check(self, names):
+        now = time.time()
+        for name in names:
+            image_path = os.path.join(self.folder, name)
+            signature = self.signature(image_path)
+            if signature is None or self.done.get(image_path) == signature:
+                self.pending.pop(image_path, None)
+                continue
+            seen = self.pending.get(image_path)
+            if seen is None or seen[0] != signature:
+                # New, or still being written
+                self.pending[image_path] = (signature, now)
+
+    def ready(self):
+        now = time.time()
+        paths = list()
+        for (image_path, (signature, since)) in list(self.pending.items()):
+            if now - since < self.settle:
+                continue
+            # Once more, in case it changed since the last look
+            if self.signature(image_path) == signature:
+                paths.append(image_path)
+            else:
+                self.pending.pop(image_path)
+                self.check([os.path.basename(image_path)])
+        paths.sort()
+        return paths
+
+    def poll(self, timeout=None):
+        # Waits up to timeout (default interval) for changes and returns
+        # the images that are ready to process
+        if timeout is None:
+            timeout = self.interval
+        if not self.started:
+            # First call: everything already in the folder
+            self.started = True
+            self.check(self.scan())
+            paths = self.ready()
+            if paths or self.pending:
+                return paths
+        if self.inotify is not None:
+            names = self.inotify.read(timeout)
+            if names is None:
+                names = self.scan()
+            self.check([name for name in names
+                        if self.pattern.match(name.lower())])
+            # Files still settling are re-checked without new events
+            self.check([os.path.basename(image_path)
+                        for image_path in list(self.pending)])
+        else:
+            time.sleep(timeout)
+            self.check(self.scan())
+        return self.ready()
+
+    def finished(self, image_paths):
+        # Marks images as processed in their current state
+        for image_path in image_paths:
+            (signature, since) = self.pending.pop(image_path,
+                                                  (None, None))
+            if signature is not None:
+                self.done[image_path] = signature
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+
+def watch(pipeline, watcher, on_result=None, on_batch=None, stopped=None,
+          on_error=None):
+    # Sorts the watched folder's images as they arrive, with the same warm
+    # pipeline, until stopped() is true. With on_error, a batch that fails
+    # is reported and skipped until its files change, instead of ending
+    # the watch
+    while stopped is None or not stopped():
+        paths = watcher.poll()
+        if not paths:
+            continue
+        try:
+            results = pipeline.run(paths, on_result=on_result)
+        except Exception as e:
+            if on_error is None:
+                raise
+            watcher.finished(paths)
+            on_error(paths, e)
+            continue
+        watcher.finished(paths)
+        if on_batch is not None:
+            on_batch(results)